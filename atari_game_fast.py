@@ -3,6 +3,21 @@ import os
 import argparse
 import random
 import math
+import functools
+import threading
+import copy
+import csv
+import traceback
+import concurrent.futures
+import contextlib
+import time
+import queue
+import json
+import glob
+import re
+import itertools
+import platform
+import torch.multiprocessing as mp
 import numpy as np
 from collections import namedtuple, deque
 import matplotlib.pyplot as plt
@@ -13,10 +28,16 @@ from gym import wrappers
 import torch
 import torch.nn as nn
 import torch.optim as optim
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
 import torch.nn.functional as F
 import torchvision.transforms as T
 from torchvision import transforms
 from tensorboardX import SummaryWriter
+try:
+    import resource
+except ImportError: # not available on windows
+    resource = None
 
 # if gpu is to be used
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
@@ -24,26 +45,432 @@ device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 ### Classes to deal replay the game for training
 Transition = namedtuple('Transition',
                         ('state', 'action', 'next_state', 'reward'))
+# a sampled batch, discount is the factor of the bootstrapped value (gamma^n for n-step returns),
+# weight are the importance-sampling weights (None for uniform sampling) and index the positions of the transitions in the memory
+Batch = namedtuple('Batch',
+                   ('state', 'action', 'reward', 'next_state', 'done', 'discount', 'weight', 'index'))
 
 class ReplayMemory(object):
-
-    def __init__(self, capacity):
-        self.memory = deque([],maxlen=capacity)
-
-    def push(self, *args):
-        """Save a transition"""
-        self.memory.append(Transition(*args))
+    """Circular replay buffer that stores every preprocessed frame only once as uint8.
+
+    A transition only keeps the ids of the frames making up its state and next_state,
+    the 4-frame stacks are rebuilt from those ids when sampling. With a directory the arrays
+    are .npy files memory mapped from it, for buffers larger than the RAM.
+    """
+
+    def __init__(self, capacity, frame_hist_len=4, frame_shape=(84,84), num_envs=1, directory=None, n_step=1):
+        self.capacity = capacity
+        self.directory = directory
+        self.frame_hist_len = frame_hist_len
+        self.frame_shape = tuple(frame_shape)
+        # the first frame of every episode is stored on top of one frame per transition, the extra room keeps
+        # the frames of the oldest transitions, of the current stacks and of the n-step windows alive
+        self.frame_capacity = capacity + capacity//16 + 2*(frame_hist_len + n_step)*num_envs
+        self.frames = self._allocate('frames', (self.frame_capacity,)+self.frame_shape, np.uint8)
+        # frame ids are never reused, frame i lives in slot i % frame_capacity
+        self.num_frames = 0
+
+        self.state_ids = self._allocate('state_ids', (capacity, frame_hist_len), np.int64)
+        self.next_state_ids = self._allocate('next_state_ids', (capacity, frame_hist_len), np.int64)
+        self.actions = self._allocate('actions', (capacity,), np.int64)
+        self.rewards = self._allocate('rewards', (capacity,), np.float32)
+        self.dones = self._allocate('dones', (capacity,), np.bool_)
+        self.discounts = self._allocate('discounts', (capacity,), np.float32)
+        self.position = 0
+        self.size = 0
+        # transitions ever stored
+        self.num_transitions = 0
+
+        # frame ids of the last next_state pushed for every stream (environment) with an open episode
+        self.last_ids = {}
+        # batches can be sampled in a background thread while transitions are stored
+        self.lock = threading.RLock()
+        # host buffers of the batches, a prefetcher needs several sets to keep batches in flight
+        self._buffers = {}
+        # cuda events recorded after the copies of every set of buffers, and the set of the last batch
+        self._copy_events = {}
+        self._buffer_key = None
+        self.buffer_sets = 1
+        self._buffer_turn = 0
+
+    def _allocate(self, name, shape, dtype):
+        if self.directory is None:
+            return np.zeros(shape, dtype=dtype)
+        # the .npy header records the dtype and shape of every file
+        os.makedirs(self.directory, exist_ok=True)
+        return np.lib.format.open_memmap(os.path.join(self.directory, name + '.npy'), mode='w+', dtype=dtype, shape=shape)
+
+    def _read(self, array, idx):
+        # on disk the rows are read once each and in file order, which suits the page cache and read-ahead
+        if self.directory is None:
+            return array[idx]
+        rows, inverse = np.unique(idx, return_inverse=True)
+        return array[rows][inverse.reshape(np.shape(idx))]
+
+    def store_frame(self, frame):
+        """Save a single frame and return its id"""
+        with self.lock:
+            frame_id = self.num_frames
+            self.frames[frame_id % self.frame_capacity] = to_uint8_frame(frame, self.frame_shape)
+            self.num_frames += 1
+        return frame_id
+
+    def store_frames(self, frames):
+        """Save a batch of uint8 frames and return their ids"""
+        with self.lock:
+            ids = self.num_frames + np.arange(len(frames))
+            self.frames[ids % self.frame_capacity] = frames
+            self.num_frames += len(frames)
+        return ids
+
+    def store_transitions(self, state_ids, actions, rewards, next_state_ids, dones, discounts):
+        """Save a batch of transitions given the frame ids of their states and next_states"""
+        with self.lock:
+            index = (self.position + np.arange(len(state_ids))) % self.capacity
+            self.state_ids[index] = state_ids
+            self.next_state_ids[index] = next_state_ids
+            self.actions[index] = actions
+            self.rewards[index] = rewards
+            self.dones[index] = dones
+            self.discounts[index] = discounts
+            self.position = (self.position + len(index)) % self.capacity
+            self.size = min(self.size + len(index), self.capacity)
+            self.num_transitions += len(index)
+        return index
+
+    def transition_arrays(self):
+        """The arrays indexed by the position of the transitions"""
+        return {'state_ids': self.state_ids, 'next_state_ids': self.next_state_ids,
+                'actions': self.actions, 'rewards': self.rewards, 'dones': self.dones, 'discounts': self.discounts}
+
+    def arrays(self):
+        """All the arrays holding the content of the memory"""
+        return dict(self.transition_arrays(), frames=self.frames)
+
+    def flush(self):
+        """Write the changes of memory mapped arrays to their files"""
+        if self.directory is not None:
+            for array in self.arrays().values():
+                array.flush()
+
+    def state_dict(self):
+        return {'num_frames': self.num_frames, 'num_transitions': self.num_transitions,
+                'position': self.position, 'size': self.size}
+
+    def load_state_dict(self, state_dict):
+        self.num_frames = state_dict['num_frames']
+        self.num_transitions = state_dict['num_transitions']
+        self.position = state_dict['position']
+        self.size = state_dict['size']
+        self.last_ids = {}
+
+    def push(self, state, action, next_state, reward, done=False, stream=0, discount=0.99):
+        """Save a transition, transitions of different environments are pushed to different streams"""
+        state_ids = self.last_ids.pop(stream, None)
+        if state_ids is None:
+            state_ids = self._store_stack(state)
+        # otherwise state is the next_state of the previous push, its frames are already stored
+        next_state_ids = np.append(state_ids[1:], self.store_frame(next_state[-1]))
+        self.store_transitions(state_ids[None], int(action), float(reward), next_state_ids[None], done, discount)
+        if not done:
+            self.last_ids[stream] = next_state_ids
+
+    def end_episode(self, stream=None):
+        """Make the next push to stream (or to every stream) start a new episode"""
+        if stream is None:
+            self.last_ids.clear()
+        else:
+            self.last_ids.pop(stream, None)
+
+    def _store_stack(self, state):
+        # the stack at the start of an episode repeats the first frame, store repeated frames once
+        ids = np.zeros(self.frame_hist_len, dtype=np.int64)
+        for i in range(self.frame_hist_len):
+            if i > 0 and torch.equal(torch.as_tensor(state[i]), torch.as_tensor(state[i-1])):
+                ids[i] = ids[i-1]
+            else:
+                ids[i] = self.store_frame(state[i])
+        return ids
+
+    def _is_valid(self, idx):
+        # a transition is stale once the oldest of its frames has been overwritten
+        return self.state_ids[idx, 0] >= self.num_frames - self.frame_capacity
+
+    def _sample_indices(self, batch_size):
+        idx = np.random.randint(0, self.size, size=batch_size)
+        stale = ~self._is_valid(idx)
+        while stale.any():
+            idx[stale] = np.random.randint(0, self.size, size=stale.sum())
+            stale = ~self._is_valid(idx)
+        return idx
+
+    def _gather_stacks(self, idx):
+        ids = np.concatenate((self.state_ids[idx], self.next_state_ids[idx]), axis=1)
+        stacks = self.frames[ids % self.frame_capacity]
+        return stacks[:, :self.frame_hist_len], stacks[:, self.frame_hist_len:]
+
+    def sample_batch(self, batch_size):
+        """Sample a Batch of tensors on device
+
+        The host side batch buffers are reused, the returned tensors are only valid until buffer_sets
+        more batches have been sampled.
+        """
+        with self.lock:
+            return self._gather_batch(self._sample_indices(batch_size))
+
+    def _batch_buffers(self, batch_size):
+        # preallocated (and pinned when copying to a gpu) host buffers, buffer_sets sets per batch size used in turn
+        self._buffer_turn = (self._buffer_turn + 1) % self.buffer_sets
+        key = (batch_size, self._buffer_turn)
+        self._buffer_key = key
+        copied = self._copy_events.pop(key, None)
+        if copied is not None:
+            # the non-blocking copies of the previous batch of this set must be done before it is overwritten
+            copied.synchronize()
+        if key not in self._buffers:
+            pin = torch.cuda.is_available()
+            self._buffers[key] = (
+                torch.empty((batch_size, 2*self.frame_hist_len)+self.frame_shape, dtype=torch.uint8, pin_memory=pin),
+                torch.empty(batch_size, dtype=torch.int64, pin_memory=pin),
+                torch.empty(batch_size, dtype=torch.float32, pin_memory=pin),
+                torch.empty(batch_size, dtype=torch.bool, pin_memory=pin),
+                torch.empty(batch_size, dtype=torch.float32, pin_memory=pin))
+        return self._buffers[key]
+
+    def _gather_batch(self, idx):
+        stacks, actions, rewards, dones, discounts = self._batch_buffers(len(idx))
+        ids = np.concatenate((self._read(self.state_ids, idx), self._read(self.next_state_ids, idx)), axis=1)
+        if self.directory is None:
+            # a single fancy-indexing read of all the frames of the states and next states
+            np.take(self.frames, ids % self.frame_capacity, axis=0, out=stacks.numpy())
+            np.take(self.actions, idx, out=actions.numpy())
+            np.take(self.rewards, idx, out=rewards.numpy())
+            np.take(self.dones, idx, out=dones.numpy())
+            np.take(self.discounts, idx, out=discounts.numpy())
+        else:
+            stacks.numpy()[...] = self._read(self.frames, ids % self.frame_capacity)
+            actions.numpy()[...] = self._read(self.actions, idx)
+            rewards.numpy()[...] = self._read(self.rewards, idx)
+            dones.numpy()[...] = self._read(self.dones, idx)
+            discounts.numpy()[...] = self._read(self.discounts, idx)
+
+        stacks = stacks.to(device, non_blocking=True).float().div_(255)
+        batch = Batch(stacks[:, :self.frame_hist_len],
+                      actions.to(device, non_blocking=True),
+                      rewards.to(device, non_blocking=True),
+                      stacks[:, self.frame_hist_len:],
+                      dones.to(device, non_blocking=True),
+                      discounts.to(device, non_blocking=True),
+                      None,
+                      idx)
+        if device.type == 'cuda':
+            # recorded after the copies, the buffers are only reused once it completed
+            copied = torch.cuda.Event()
+            copied.record()
+            self._copy_events[self._buffer_key] = copied
+        return batch
 
     def sample(self, batch_size):
-        return random.sample(self.memory, batch_size)
+        idx = self._sample_indices(batch_size)
+        states, next_states = self._gather_stacks(idx)
+        states = torch.from_numpy(states).to(device).float().div_(255)
+        next_states = torch.from_numpy(next_states).to(device).float().div_(255)
+        transitions = []
+        for i, j in enumerate(idx):
+            transitions.append(Transition(states[i],
+                                          torch.tensor([[self.actions[j]]], device=device),
+                                          None if self.dones[j] else next_states[i],
+                                          torch.tensor([self.rewards[j]], device=device)))
+        return transitions
 
     def __len__(self):
-        return len(self.memory)
+        return self.size
+
+class SumTree(object):
+    """Array based binary tree where every node holds the sum of its two children.
+
+    Node 1 is the root, the children of node i are 2i and 2i+1 and the leaves start at
+    leaf_start. Updates and prefix-sum searches are vectorized over a whole batch and only
+    loop over the depth of the tree.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.leaf_start = 1 << max(capacity-1, 1).bit_length()
+        self.tree = np.zeros(2*self.leaf_start, dtype=np.float64)
+
+    def total(self):
+        return self.tree[1]
+
+    def get(self, idx):
+        return self.tree[np.asarray(idx) + self.leaf_start]
+
+    def update(self, idx, values):
+        nodes = np.asarray(idx, dtype=np.int64) + self.leaf_start
+        self.tree[nodes] = values
+        nodes = np.unique(nodes // 2)
+        while nodes[0] > 0:
+            self.tree[nodes] = self.tree[2*nodes] + self.tree[2*nodes+1]
+            nodes = np.unique(nodes // 2)
+
+    def find(self, values):
+        """Return the leaves at which the cumulative sums reach the given values"""
+        values = np.array(values, dtype=np.float64)
+        nodes = np.ones(len(values), dtype=np.int64)
+        while nodes[0] < self.leaf_start:
+            left = 2*nodes
+            go_right = values >= self.tree[left]
+            values = np.where(go_right, values - self.tree[left], values)
+            nodes = np.where(go_right, left + 1, left)
+        return nodes - self.leaf_start
+
+class PrioritizedReplayMemory(ReplayMemory):
+    """Replay memory sampling transitions in proportion to priority^alpha (Schaul et al. 2015).
+
+    New transitions get the highest priority seen so far, the priorities are updated with
+    the TD-errors of the sampled batch through update_priorities.
+    """
+
+    def __init__(self, capacity, frame_hist_len=4, frame_shape=(84,84), num_envs=1, directory=None, n_step=1,
+                 alpha=0.6, beta=0.4, beta_steps=100000, eps=1e-6):
+        super(PrioritizedReplayMemory, self).__init__(capacity, frame_hist_len, frame_shape, num_envs, directory, n_step)
+        self.tree = SumTree(capacity)
+        self.alpha = alpha
+        # beta is annealed linearly from its start value to 1 over beta_steps sampled batches
+        self.beta_start = beta
+        self.beta_steps = beta_steps
+        self.eps = eps
+        self.max_priority = 1.0
+        self.num_sampled = 0
+
+    @property
+    def beta(self):
+        return min(1.0, self.beta_start + (1.0 - self.beta_start) * self.num_sampled / self.beta_steps)
+
+    def store_transitions(self, state_ids, actions, rewards, next_state_ids, dones, discounts):
+        index = super(PrioritizedReplayMemory, self).store_transitions(state_ids, actions, rewards, next_state_ids, dones, discounts)
+        self.tree.update(index, self.max_priority ** self.alpha)
+        return index
+
+    def _sample_indices(self, batch_size):
+        # stratified sampling: one draw in each of batch_size equal segments of the total priority
+        total = self.tree.total()
+        values = (np.arange(batch_size) + np.random.rand(batch_size)) * (total / batch_size)
+        idx = self.tree.find(values)
+        bad = self._invalid(idx)
+        while bad.any():
+            idx[bad] = self.tree.find(np.random.rand(bad.sum()) * self.tree.total())
+            bad = self._invalid(idx)
+        return idx
+
+    def _invalid(self, idx):
+        # rounding can land the search on an empty leaf, stale transitions are dropped from the tree
+        empty = (idx >= self.size) | (self.tree.get(idx) <= 0)
+        stale = ~self._is_valid(np.minimum(idx, self.size - 1)) & ~empty
+        if stale.any():
+            self.tree.update(idx[stale], 0)
+        return empty | stale
+
+    def sample_batch(self, batch_size):
+        with self.lock:
+            idx = self._sample_indices(batch_size)
+            probs = self.tree.get(idx) / self.tree.total()
+            weights = (self.size * probs) ** (-self.beta)
+            weights /= weights.max()
+            self.num_sampled += 1
+            return self._gather_batch(idx)._replace(weight=torch.as_tensor(weights, dtype=torch.float32, device=device))
+
+    def state_dict(self):
+        state_dict = super(PrioritizedReplayMemory, self).state_dict()
+        state_dict.update(max_priority=self.max_priority, num_sampled=self.num_sampled,
+                          priorities=self.tree.get(np.arange(self.capacity)).copy())
+        return state_dict
+
+    def load_state_dict(self, state_dict):
+        super(PrioritizedReplayMemory, self).load_state_dict(state_dict)
+        self.max_priority = state_dict['max_priority']
+        self.num_sampled = state_dict['num_sampled']
+        self.tree.update(np.arange(self.capacity), state_dict['priorities'])
+
+    def update_priorities(self, idx, td_errors):
+        priorities = np.abs(td_errors) + self.eps
+        with self.lock:
+            self.max_priority = max(self.max_priority, priorities.max())
+            self.tree.update(idx, priorities ** self.alpha)
+
+class BatchPrefetcher(object):
+    """Keeps up to num_batches batches of a replay memory ready, sampled by a background thread.
+
+    The batches are assembled in the pinned host buffers of the memory and copied to the gpu with
+    non-blocking copies on a separate stream, so sampling and transfers overlap the gradient steps.
+    On the cpu the thread only does the sampling.
+    """
+
+    def __init__(self, memory, batch_size, num_batches=1):
+        self.memory = memory
+        self.batch_size = batch_size
+        # the batches in the queue, the one being sampled and the one in use must not share host buffers
+        self.memory.buffer_sets = max(self.memory.buffer_sets, num_batches + 2)
+        self.batches = queue.Queue(maxsize=num_batches)
+        self.stop = threading.Event()
+        self.thread = None
+
+    def _sample_batches(self):
+        stream = torch.cuda.Stream() if device.type == 'cuda' else None
+        try:
+            while not self.stop.is_set():
+                if stream is None:
+                    item = (self.memory.sample_batch(self.batch_size), None)
+                else:
+                    with torch.cuda.stream(stream):
+                        batch = self.memory.sample_batch(self.batch_size)
+                        copied = torch.cuda.Event()
+                        copied.record(stream)
+                    item = (batch, copied)
+                while not self.stop.is_set():
+                    try:
+                        self.batches.put(item, timeout=0.1)
+                        break
+                    except queue.Full:
+                        pass
+        except Exception as error:
+            # raised again by sample_batch in the training loop
+            self.batches.put((error, None))
+
+    def sample_batch(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._sample_batches, daemon=True)
+            self.thread.start()
+        batch, copied = self.batches.get()
+        if isinstance(batch, Exception):
+            raise batch
+        if copied is not None:
+            # the tensors were copied on the stream of the thread, wait for them and hand them to this stream
+            current_stream = torch.cuda.current_stream()
+            current_stream.wait_event(copied)
+            for tensor in batch:
+                if torch.is_tensor(tensor):
+                    tensor.record_stream(current_stream)
+        return batch
+
+    def close(self):
+        self.stop.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+def to_uint8_frame(frame, frame_shape=(84,84)):
+    # float frames are in [0,1]
+    if torch.is_tensor(frame):
+        if frame.is_floating_point():
+            frame = frame.mul(255).round_()
+        frame = frame.to('cpu', torch.uint8).numpy()
+    return np.asarray(frame, dtype=np.uint8).reshape(frame_shape)
 
 class CNN_2c2f(nn.Module):
-    def __init__(self):
+    def __init__(self, in_channels=4):
         super(CNN_2c2f, self).__init__()
-        self.conv1 = nn.Conv2d(4,16,8,stride=4) #output will be 20x20 feature
+        self.conv1 = nn.Conv2d(in_channels,16,8,stride=4) #output will be 20x20 feature
         self.conv2 = nn.Conv2d(16,32,4,stride=2) #output will be 9x9
         self.fc1 = nn.Linear(32*81,256)
         self.fc2 = nn.Linear(256,6)
@@ -53,7 +480,7 @@ class CNN_2c2f(nn.Module):
         #pdb.set_trace()
         x = F.relu(self.conv1(x))
         x = F.relu(self.conv2(x))
-        x = x.view(-1,32*81)
+        x = x.reshape(-1,32*81) # reshape as the channels-last and quantized layouts are not contiguous
         x = F.relu(self.fc1(x))
         x = self.fc2(x)
         return x
@@ -65,7 +492,7 @@ class LinearQN(nn.Module):
         self.fc = nn.Linear(n_in, n_out)
 
     def forward(self, x):
-        x = self.fc(x)
+        x = self.fc(x.reshape(x.size(0), -1))
         return x
 
 class DQN(nn.Module):
@@ -77,7 +504,7 @@ class DQN(nn.Module):
         self.fc4 = nn.Linear(n_hidden, n_out)
 
     def forward(self, x):
-        x = F.relu(self.fc1(x))
+        x = F.relu(self.fc1(x.reshape(x.size(0), -1)))
         x = F.relu(self.fc2(x))
         x = F.relu(self.fc3(x))
         x = self.fc4(x)
@@ -98,7 +525,7 @@ class DuelingDQN(nn.Module):
         self.fc2_val = nn.Linear(n_hidden, 1)
 
     def forward(self, x):
-        x = F.relu(self.fc1(x))
+        x = F.relu(self.fc1(x.reshape(x.size(0), -1)))
         x = F.relu(self.fc2(x))
 
         adv = F.relu(self.fc1_adv(x))
@@ -110,237 +537,1536 @@ class DuelingDQN(nn.Module):
         x = val + adv - adv.mean(1).unsqueeze(1).expand(x.size(0), self.n_actions)
         return x
 
-pre_process = transforms.Compose([
+################################################################################################################################################
+### Resumable checkpoints: the agent state and the replay memory
+
+def atomic_torch_save(obj, path):
+    """torch.save that leaves either the previous file or the complete new one, even on a crash"""
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        torch.save(obj, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+class Checkpointer(object):
+    """Writes resumable checkpoints to a directory.
+
+    The agent state goes to agent.pt with atomic_torch_save, every array of the replay memory to its
+    own .npy file which is memory mapped and only updated with the frames and transitions stored since
+    the previous checkpoint. Those changes are copied in bounded chunks and written by a background
+    thread while the training goes on. replay.dirty exists while the replay files are being updated, a
+    replay memory interrupted in the middle of a write is not loaded again.
+    """
+
+    # bytes copied from the memory at a time
+    chunk_bytes = 16 << 20
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.thread = None
+        # frames and transitions ever stored in the memory when the replay files were last written
+        self.saved_frames = 0
+        self.saved_transitions = 0
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def save(self, agent_state, memory):
+        """Save agent_state, which must not be modified afterwards, and the changes of memory"""
+        self.wait()
+        self.thread = threading.Thread(target=self._write, args=(agent_state, memory))
+        self.thread.start()
+
+    def _open(self, name, shape, dtype):
+        path = self._path(name + '.npy')
+        if os.path.exists(path):
+            array = np.load(path, mmap_mode='r+')
+            if array.shape == shape and array.dtype == dtype:
+                return array
+            del array
+        # a new file, everything in memory has to be written
+        return np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=shape)
+
+    def _chunks(self, ids, arrays):
+        # the memory is copied a bounded number of bytes at a time, the training loop waits for its lock during one chunk at most
+        row_bytes = sum(array[0].nbytes for array in arrays)
+        size = max(1, self.chunk_bytes // row_bytes)
+        return [ids[i:i+size] for i in range(0, len(ids), size)]
+
+    def _write(self, agent_state, memory):
+        dirty = self._path('replay.dirty')
+        open(dirty, 'w').close()
+        with memory.lock:
+            memory_state = memory.state_dict()
+            num_frames, num_transitions = memory.num_frames, memory.num_transitions
+        # memory mapped arrays are copied from their files once flushed, without keeping their changes in RAM
+        memory.flush()
+        files = {name: self._open(name, array.shape, array.dtype) for name, array in memory.arrays().items()}
+
+        # copy what changed since the last checkpoint, the memory keeps changing during the copy
+        transition_ids = np.arange(max(self.saved_transitions, num_transitions - memory.capacity), num_transitions)
+        for ids in self._chunks(transition_ids, memory.transition_arrays().values()):
+            with memory.lock:
+                positions = ids % memory.capacity
+                for name, array in memory.transition_arrays().items():
+                    files[name][positions] = array[positions]
+                overwritten = positions[ids < memory.num_transitions - memory.capacity]
+            # the transitions stored over them reference frames that are not saved, a frame id
+            # older than the frame ring makes these stale
+            files['state_ids'][overwritten, 0] = -memory.frame_capacity - 1
+        frame_ids = np.arange(max(self.saved_frames, num_frames - memory.frame_capacity), num_frames)
+        for ids in self._chunks(frame_ids, [memory.frames]):
+            with memory.lock:
+                slots = ids % memory.frame_capacity
+                files['frames'][slots] = memory.frames[slots]
+        # the transitions whose frames were overwritten during the copy are stale with the number of frames after it
+        with memory.lock:
+            memory_state['num_frames'] = memory.num_frames
+
+        for array in files.values():
+            array.flush()
+        del files
+        atomic_torch_save(dict(agent_state, memory=memory_state), self._path('agent.pt'))
+        os.remove(dirty)
+        self.saved_frames = num_frames
+        self.saved_transitions = num_transitions
+
+    def wait(self):
+        """Wait for the checkpoint being written"""
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def exists(self):
+        return os.path.exists(self._path('agent.pt'))
+
+    def load(self, memory):
+        """Returns the agent state of the last checkpoint and whether memory (None to skip it) could be restored as well"""
+        # on the cpu: the rng states must stay cpu tensors, load_state_dict moves the weights to their device
+        agent_state = torch.load(self._path('agent.pt'), map_location='cpu', weights_only=False)
+        if memory is None:
+            return agent_state, False
+        if os.path.exists(self._path('replay.dirty')):
+            print('The replay memory of the checkpoint was not completely written, starting with an empty one')
+            return agent_state, False
+        arrays = {}
+        for name, array in memory.arrays().items():
+            path = self._path(name + '.npy')
+            saved = np.load(path, mmap_mode='r') if os.path.exists(path) else None
+            if saved is None or saved.shape != array.shape or saved.dtype != array.dtype:
+                print('The replay memory of the checkpoint does not match the buffer size, starting with an empty one')
+                return agent_state, False
+            arrays[name] = saved
+        for name, array in memory.arrays().items():
+            array[...] = arrays[name]
+        memory.load_state_dict(agent_state['memory'])
+        # the files on disk are up to date with the memory
+        self.saved_frames = memory.num_frames
+        self.saved_transitions = memory.num_transitions
+        return agent_state, True
+
+################################################################################################################################################
+### Frame preprocessing: grayscale and downsample the 210x160x3 frames to 84x84, uint8 in and out
+
+# the former torchvision pipeline, only kept as the reference of benchmark_pre_process
+pre_process_torchvision = transforms.Compose([
     transforms.ToTensor(),
     transforms.Grayscale(),
     transforms.Resize([84,84]),
     #transforms.Normalize(0,255)
     ] )
 
+def grayscale(frames):
+    """Grayscale a frame (H,W,3) or a batch of frames (N,H,W,3)"""
+    frames = np.ascontiguousarray(frames)
+    # cv2 converts a single image, the batch is converted as one tall image
+    gray = cv2.cvtColor(frames.reshape(-1, frames.shape[-2], 3), cv2.COLOR_RGB2GRAY)
+    return gray.reshape(frames.shape[:-1])
+
+def resize(frames, frame_shape=(84,84)):
+    """Area-resize a grayscale frame (H,W) or a batch of frames (N,H,W)"""
+    frames = np.ascontiguousarray(frames)
+    num_frames = 1 if frames.ndim == 2 else frames.shape[0]
+    # the batch is resized as one tall image, every frame maps to exactly frame_shape[0] output rows
+    # so no output pixel mixes two frames
+    resized = cv2.resize(frames.reshape(-1, frames.shape[-1]), (frame_shape[1], num_frames*frame_shape[0]),
+                         interpolation=cv2.INTER_AREA)
+    return resized.reshape(frames.shape[:-2]+tuple(frame_shape))
+
+def pre_process(frames, frame_shape=(84,84)):
+    """Grayscale and resize a frame (H,W,3) or a batch of frames (N,H,W,3)"""
+    return resize(grayscale(frames), frame_shape)
+
+class FramePreprocessor(object):
+    """Preprocesses the observations of a set of environments.
+
+    With max_pool every frame is the pixel-wise max of the grayscale observation and the previous
+    one of the same environment, which removes the sprites that Atari games only draw every other frame.
+    """
+
+    def __init__(self, frame_shape=(84,84), max_pool=True):
+        self.frame_shape = tuple(frame_shape)
+        self.max_pool = max_pool
+        self.last = None
+
+    def reset(self, observations, index=None):
+        """Frames of the first observations of new episodes, index selects the environments that were reset"""
+        gray = grayscale(observations)
+        if self.max_pool:
+            if self.last is None or index is None:
+                self.last = gray.copy()
+            else:
+                self.last[index] = gray
+        return resize(gray, self.frame_shape)
+
+    def __call__(self, observations):
+        gray = grayscale(observations)
+        if self.max_pool:
+            pooled = np.maximum(gray, self.last)
+            self.last = gray
+            gray = pooled
+        return resize(gray, self.frame_shape)
+
+def benchmark_pre_process(num_frames=2000, batch_size=8):
+    """Print the frames/sec of the torchvision pipeline and of the cv2 one, frame by frame and batched"""
+    frames = StubAtariEnv().frames
+    frames = frames[np.arange(num_frames) % len(frames)]
+
+    def frames_per_sec(fn, step):
+        start = time.perf_counter()
+        for i in range(0, num_frames, step):
+            fn(frames[i:i+step])
+        return num_frames / (time.perf_counter() - start)
+
+    results = {
+        'torchvision': frames_per_sec(lambda f: pre_process_torchvision(f[0]), 1),
+        'cv2': frames_per_sec(lambda f: pre_process(f[0]), 1),
+        f'cv2 batch {batch_size}': frames_per_sec(pre_process, batch_size),
+    }
+    preprocessor = FramePreprocessor()
+    preprocessor.reset(frames[:batch_size])
+    results[f'cv2 max-pool batch {batch_size}'] = frames_per_sec(preprocessor, batch_size)
+    for name, fps in results.items():
+        print("{:<24} {:>10.0f} frames/sec".format(name, fps))
+    return results
+
+class NStepReturns(object):
+    """Rolling window of the last n transitions of every environment, turned into n-step transitions.
+
+    Once the window of an environment is full its oldest transition comes out with the discounted sum of
+    the n rewards, the next state of the newest transition and a discount of gamma^n. When an episode
+    ends every transition of its window comes out, with the rewards up to the end and done set.
+    """
+
+    def __init__(self, num_envs, n=1, gamma=0.99, frame_hist_len=4):
+        self.n = n
+        self.gamma = gamma
+        # gamma^0 .. gamma^n
+        self.discounts = gamma ** np.arange(n + 1)
+        self.state_ids = np.zeros((n, num_envs, frame_hist_len), dtype=np.int64)
+        self.actions = np.zeros((n, num_envs), dtype=np.int64)
+        self.rewards = np.zeros((n, num_envs))
+        # number of transitions in the window of every environment and slot of the newest ones
+        self.count = np.zeros(num_envs, dtype=np.int64)
+        self.t = 0
+
+    def reset(self):
+        """Drop the transitions of the episodes that will not be continued"""
+        self.count[:] = 0
+
+    def add(self, state_ids, actions, rewards, next_state_ids, dones):
+        """Add a step of every environment, returns the completed transitions
+        (state_ids, actions, returns, next_state_ids, dones, discounts) or None"""
+        n = self.n
+        if n == 1:
+            return state_ids, actions, rewards, next_state_ids, dones, np.full(len(actions), self.gamma, dtype=np.float32)
+        self.t = (self.t + 1) % n
+        self.state_ids[self.t] = state_ids
+        self.actions[self.t] = actions
+        self.rewards[self.t] = rewards
+        self.count = np.minimum(self.count + 1, n)
+        # slots of a full window from its oldest to its newest transition
+        slots = (self.t + 1 + np.arange(n)) % n
+
+        completed = []
+        full = np.flatnonzero((self.count == n) & ~dones)
+        if len(full) > 0:
+            oldest = slots[0]
+            completed.append((self.state_ids[oldest, full], self.actions[oldest, full],
+                              self.discounts[:n] @ self.rewards[slots][:, full], next_state_ids[full],
+                              np.zeros(len(full), dtype=np.bool_), np.full(len(full), self.discounts[n])))
+        for i in np.flatnonzero(dones):
+            # the c transitions of the window all end with the episode
+            c = self.count[i]
+            window = slots[n - c:]
+            rewards_i = self.rewards[window, i]
+            completed.append((self.state_ids[window, i], self.actions[window, i],
+                              np.array([self.discounts[:c - j] @ rewards_i[j:] for j in range(c)]),
+                              np.repeat(next_state_ids[i][None], c, axis=0),
+                              np.ones(c, dtype=np.bool_), self.discounts[c - np.arange(c)]))
+            self.count[i] = 0
+        if not completed:
+            return None
+        return tuple(np.concatenate(parts) for parts in zip(*completed))
+
+class FrameStack(object):
+    """Rolling stack of the last k frames of every environment.
+
+    Every frame is written twice, at slots t and t+k of a buffer of 2k slots, so the last k frames
+    are always contiguous and state() is a view instead of a copy. The ids the replay memory gave to
+    the frames are kept the same way, transitions are stored as frame ids rather than copied stacks.
+    """
+
+    def __init__(self, num_envs, k=4, frame_shape=(84,84)):
+        self.k = k
+        self.frames = torch.zeros((num_envs, 2*k)+tuple(frame_shape), dtype=torch.uint8, device=device)
+        self.frame_ids = np.zeros((num_envs, 2*k), dtype=np.int64)
+        self.t = 0
+
+    def reset(self, frames, ids, index=None):
+        """Start new episodes from frames, index selects the environments that were reset"""
+        # the stack at the start of an episode repeats its first frame
+        if index is None:
+            index = np.ones(len(self.frame_ids), dtype=np.bool_)
+        frames = torch.as_tensor(frames).to(device, non_blocking=True)
+        self.frames[torch.from_numpy(index).to(device)] = frames[:, None]
+        self.frame_ids[index] = np.asarray(ids)[:, None]
+
+    def push(self, frames, ids):
+        """Add the newest frame of every environment"""
+        frames = torch.as_tensor(frames).to(device, non_blocking=True)
+        self.frames[:, self.t] = frames
+        self.frames[:, self.t + self.k] = frames
+        self.frame_ids[:, self.t] = ids
+        self.frame_ids[:, self.t + self.k] = ids
+        self.t = (self.t + 1) % self.k
+
+    def state(self):
+        """View of the stacked states, only valid until the next push"""
+        return self.frames[:, self.t:self.t + self.k]
+
+    def ids(self):
+        """Frame ids of the stacked states, only valid until the next push"""
+        return self.frame_ids[:, self.t:self.t + self.k]
+
+################################################################################################################################################
+### Vectorized environments: step several copies of the game for every forward pass of the model
+
+class StubAtariEnv(gym.Env):
+    """Deterministic stand-in for SpaceInvaders-v0 that needs no ROMs.
+
+    It has the same observation and action spaces, the frames are picked from a fixed bank of
+    random images by the step count and the action, so runs are reproducible for a given seed.
+    """
+    metadata = {'render.modes': ['rgb_array']}
+
+    def __init__(self, episode_len=500, seed=0, num_frames=64):
+        self.observation_space = gym.spaces.Box(low=0, high=255, shape=(210,160,3), dtype=np.uint8)
+        self.action_space = gym.spaces.Discrete(6)
+        self.episode_len = episode_len
+        self.num_frames = num_frames
+        self.seed(seed)
+
+    def seed(self, seed=None):
+        rng = np.random.RandomState(seed)
+        self.frames = rng.randint(0, 256, size=(self.num_frames,)+self.observation_space.shape, dtype=np.uint8)
+        self.frames.flags.writeable = False
+        return [seed]
+
+    def reset(self):
+        self.t = 0
+        self.frame = self.frames[0]
+        return self.frame
+
+    def step(self, action):
+        self.t += 1
+        action = int(action)
+        self.frame = self.frames[(7*self.t + action) % self.num_frames]
+        reward = 1.0 if (self.t + action) % 10 == 0 else 0.0
+        return self.frame, reward, self.t >= self.episode_len, {}
+
+    def render(self, mode='rgb_array'):
+        return self.frame
+
+def make_env(env_id, index=0):
+    if env_id == 'StubAtari-v0':
+        return StubAtariEnv(seed=index)
+    return gym.make(env_id)
+
+class SyncVectorEnv(object):
+    """Steps a list of environments one after another in this process.
+
+    Finished environments are reset straight away: the observation returned for them is the first
+    one of the next episode and the last one of the finished episode is in info['terminal_observation'].
+    """
+
+    def __init__(self, env_fns):
+        self.envs = [env_fn() for env_fn in env_fns]
+        self.num_envs = len(self.envs)
+        self.observation_space = self.envs[0].observation_space
+        self.action_space = self.envs[0].action_space
+        self.observations = np.zeros((self.num_envs,)+self.observation_space.shape, dtype=self.observation_space.dtype)
+
+    def reset(self):
+        for i, env in enumerate(self.envs):
+            self.observations[i] = env.reset()
+        return self.observations
+
+    def step(self, actions):
+        """Returns observations, rewards, dones and infos, the observations are overwritten by the next step"""
+        rewards = np.zeros(self.num_envs, dtype=np.float32)
+        dones = np.zeros(self.num_envs, dtype=np.bool_)
+        infos = []
+        for i, env in enumerate(self.envs):
+            obs, rewards[i], dones[i], info = env.step(actions[i])
+            if dones[i]:
+                info['terminal_observation'] = obs
+                obs = env.reset()
+            self.observations[i] = obs
+            infos.append(info)
+        return self.observations, rewards, dones, infos
+
+    def render(self, mode='human', index=0):
+        return self.envs[index].render(mode)
+
+    def close(self):
+        for env in self.envs:
+            env.close()
+
+def _subproc_env_worker(remote, parent_remote, env_fn, shared_obs, index, obs_shape, obs_dtype):
+    parent_remote.close()
+    env = env_fn()
+    observation = np.frombuffer(shared_obs, dtype=obs_dtype).reshape((-1,)+obs_shape)[index]
+    try:
+        while True:
+            cmd, data = remote.recv()
+            if cmd == 'step':
+                obs, reward, done, info = env.step(data)
+                if done:
+                    info['terminal_observation'] = obs
+                    obs = env.reset()
+                observation[:] = obs
+                remote.send((reward, done, info))
+            elif cmd == 'reset':
+                observation[:] = env.reset()
+                remote.send(None)
+            elif cmd == 'render':
+                remote.send(env.render(data))
+            elif cmd == 'close':
+                env.close()
+                remote.close()
+                break
+    except KeyboardInterrupt:
+        pass
+
+class SubprocVectorEnv(object):
+    """Runs every environment in its own process, same interface as SyncVectorEnv.
+
+    Observations are written by the workers straight into a shared memory buffer, only the
+    actions, rewards, done flags and infos go through the pipes.
+    """
+
+    def __init__(self, env_fns):
+        self.num_envs = len(env_fns)
+        env = env_fns[0]()
+        self.observation_space = env.observation_space
+        self.action_space = env.action_space
+        env.close()
+
+        obs_shape = self.observation_space.shape
+        obs_dtype = np.dtype(self.observation_space.dtype)
+        ctx = mp.get_context()
+        shared_obs = ctx.RawArray('B', self.num_envs*int(np.prod(obs_shape))*obs_dtype.itemsize)
+        self.observations = np.frombuffer(shared_obs, dtype=obs_dtype).reshape((self.num_envs,)+obs_shape)
+
+        self.remotes, self.processes = [], []
+        for i, env_fn in enumerate(env_fns):
+            remote, worker_remote = ctx.Pipe()
+            process = ctx.Process(target=_subproc_env_worker, daemon=True,
+                                  args=(worker_remote, remote, env_fn, shared_obs, i, obs_shape, obs_dtype))
+            process.start()
+            worker_remote.close()
+            self.remotes.append(remote)
+            self.processes.append(process)
+        self.closed = False
+
+    def reset(self):
+        for remote in self.remotes:
+            remote.send(('reset', None))
+        for remote in self.remotes:
+            remote.recv()
+        return self.observations
+
+    def step(self, actions):
+        """Returns observations, rewards, dones and infos, the observations are overwritten by the next step"""
+        for remote, action in zip(self.remotes, actions):
+            remote.send(('step', action))
+        rewards, dones, infos = zip(*[remote.recv() for remote in self.remotes])
+        return self.observations, np.array(rewards, dtype=np.float32), np.array(dones, dtype=np.bool_), list(infos)
+
+    def render(self, mode='human', index=0):
+        self.remotes[index].send(('render', mode))
+        return self.remotes[index].recv()
+
+    def close(self):
+        if self.closed:
+            return
+        for remote in self.remotes:
+            remote.send(('close', None))
+        for process in self.processes:
+            process.join()
+        self.closed = True
+
+def make_vector_env(env_id, num_envs, mode='sync', env_offset=0):
+    env_fns = [functools.partial(make_env, env_id, env_offset + i) for i in range(num_envs)]
+    if mode == 'subproc':
+        return SubprocVectorEnv(env_fns)
+    return SyncVectorEnv(env_fns)
+
+################################################################################################################################################
+### Training metrics: wall time of the training loop stages and running means, flushed to tensorboard
+
+class TrainingMetrics(object):
+    """Cumulative wall time of the training loop stages and running means of training values.
+
+    The values are accumulated in place, tensors on their device so that an update does not wait for
+    the gpu, and written to tensorboard every flush_every environment steps. Without a writer only the
+    profiler window is handled. Stages running on a gpu are timed until their kernels are queued.
+    """
+    STAGES = ('env_step', 'pre_process', 'select_action', 'replay_push',
+              'replay_sample', 'forward', 'backward', 'optimizer_step')
+
+    def __init__(self, writer=None, flush_every=1000, profile=''):
+        self.writer = writer
+        self.flush_every = flush_every
+        # seconds spent in every stage since the start and at the last flush
+        self.times = dict.fromkeys(self.STAGES, 0.)
+        self.flushed_times = dict(self.times)
+        # name -> (sum, count) of the values added since the last flush
+        self.values = {}
+        self.env_steps = 0
+        self.flushed_steps = 0
+        self.flushed_at = time.perf_counter()
+
+        # torch.profiler capture between two environment steps given as 'start:end'
+        self.profiler = None
+        self.profile_window = None
+        if profile:
+            start, _, end = profile.partition(':')
+            if not start.isdigit() or not end.isdigit() or int(end) <= int(start):
+                raise ValueError(f'profile should be start:end environment steps, got {profile}')
+            self.profile_window = (int(start), int(end))
+
+    @contextlib.contextmanager
+    def time(self, stage):
+        if self.writer is None and self.profiler is None:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            if self.profiler is not None:
+                # the stages show up as ranges in the profiler trace
+                with torch.profiler.record_function(stage):
+                    yield
+            else:
+                yield
+        finally:
+            self.times[stage] += time.perf_counter() - start
+
+    def add(self, name, value):
+        """Add value, a number or a tensor, to the running mean of name"""
+        if self.writer is None:
+            return
+        total, count = self.values.get(name, (0., 0))
+        self.values[name] = (total + value, count + 1)
+
+    def step(self, env_steps):
+        """Count env_steps environment steps, flushing and starting or stopping the profiler when due"""
+        self.env_steps += env_steps
+        if self.profile_window is not None:
+            start, end = self.profile_window
+            if self.profiler is None and start <= self.env_steps < end:
+                self.start_profiler()
+            elif self.profiler is not None and self.env_steps >= end:
+                self.stop_profiler()
+        if self.writer is not None and self.env_steps - self.flushed_steps >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        if self.writer is None:
+            return
+        now = time.perf_counter()
+        step = self.env_steps
+        wall_time = now - self.flushed_at
+        if wall_time > 0:
+            self.writer.add_scalar('perf/steps_per_sec', (step - self.flushed_steps) / wall_time, step)
+        for stage, seconds in self.times.items():
+            self.writer.add_scalar(f'time/{stage}', seconds, step)
+            if wall_time > 0:
+                # share of the wall time since the last flush
+                self.writer.add_scalar(f'time_share/{stage}', (seconds - self.flushed_times[stage]) / wall_time, step)
+        for name, (total, count) in self.values.items():
+            self.writer.add_scalar(f'train/{name}', float(total) / count, step)
+        self.values = {}
+        self.flushed_times = dict(self.times)
+        self.flushed_steps = step
+        self.flushed_at = now
+
+    def start_profiler(self):
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        self.profiler = torch.profiler.profile(activities=activities, record_shapes=True)
+        self.profiler.start()
+        print("Profiling from environment step {}".format(self.env_steps))
+
+    def stop_profiler(self):
+        profiler, self.profiler = self.profiler, None
+        profiler.stop()
+        # the trace opens in chrome://tracing or perfetto
+        trace_dir = self.writer.logdir if self.writer is not None else '.'
+        path = os.path.join(trace_dir, 'profile_{}_{}.json'.format(*self.profile_window))
+        profiler.export_chrome_trace(path)
+        print(profiler.key_averages().table(sort_by='self_cpu_time_total', row_limit=20))
+        print("Profiler trace written to {}".format(path))
+
+    def close(self):
+        if self.profiler is not None:
+            self.stop_profiler()
+        self.flush()
+
+################################################################################################################################################
+
+def make_model(args, n_in, n_out):
+    # type of function approximator to use
+    if args.model_type == 'CNN_2c2f':
+        return CNN_2c2f(args.frame_hist_len)
+    elif args.model_type == 'linear':
+        return LinearQN(n_in, n_out)
+    elif args.model_type == 'dqn':
+        return DQN(n_in, args.n_hidden, n_out)
+    else:
+        return DuelingDQN(n_in, args.n_hidden, n_out)
+
+def make_optimizer(args, parameters):
+    # with fused_optimizer every step updates all the parameters in one kernel (fused, only Adam has one)
+    # or in one op per tensor kind (foreach), the hyper-parameters stay the same
+    options = {}
+    if args.fused_optimizer:
+        options = {'fused': True} if args.optimizer == 'adam' else {'foreach': True}
+    if args.optimizer == 'rmsprop':
+        return optim.RMSprop(parameters, lr=args.lr, **options)
+    return optim.Adam(parameters, lr=args.lr, **options)
+
+def autocast(enabled):
+    # mixed precision: bfloat16 on the cpu, float16 on a gpu where it needs a GradScaler
+    if not enabled:
+        return contextlib.nullcontext()
+    dtype = torch.float16 if device.type == 'cuda' else torch.bfloat16
+    return torch.autocast(device.type, dtype=dtype)
+
+def make_grad_scaler(args):
+    # scales the float16 loss so that small gradients do not underflow, a no-op when disabled
+    enabled = bool(args.amp) and device.type == 'cuda'
+    if hasattr(torch.amp, 'GradScaler'):
+        return torch.amp.GradScaler('cuda', enabled=enabled)
+    # before torch 2.3
+    return torch.cuda.amp.GradScaler(enabled=enabled)
+
+class Actor(object):
+    """Plays num_envs copies of the game with the (epsilon-greedy) policy of model.
+
+    The transitions go to memory, which only needs store_frames and store_transitions: the replay
+    memory itself, or an ExperienceSender when the actor runs in its own process.
+    """
+
+    def __init__(self, args, model=None, memory=None, env_offset=0):
+        # num_envs copies of the game are stepped together, in this process or in subprocesses
+        self.envs = make_vector_env(args.env, args.num_envs, args.vec_env, env_offset)
+        self.num_envs = args.num_envs
+        # self.env = gym.wrappers.Monitor(self.env, directory='monitors/'+args.env, force=True)
+        # the fully connected models see the stacked preprocessed 84x84 frames flattened
+        self.n_in = args.frame_hist_len*84*84
+        self.n_actions = self.envs.action_space.n
+
+        self.model = model
+        self.memory = memory
+        self.pre_process = FramePreprocessor(max_pool=args.max_pool)
+        self.frame_stack = FrameStack(self.num_envs, args.frame_hist_len)
+        # the transitions go through the n-step returns on their way to memory
+        self.n_step_returns = NStepReturns(self.num_envs, args.n_step, args.gamma, args.frame_hist_len)
+
+        # policy type
+        if args.eps_greedy:
+            self.eps_greedy = True
+            self.eps_start = args.eps_start
+            self.eps_end = args.eps_end
+            self.eps_decay = args.eps_decay
+        else:
+            self.eps_greedy = False
+        self.steps_done = 0
+        # timings of the acting stages, set by the agent
+        self.metrics = TrainingMetrics()
+
+        # length and total reward of the episode played by every environment
+        self.episode_steps = np.zeros(self.num_envs, dtype=np.int64)
+        self.episode_rewards = np.zeros(self.num_envs)
+
+    @property
+    def epsilon(self):
+        # linearly decaying the epsilon threshold value as we progress
+        # return self.eps_end + (self.eps_start - self.eps_end) * math.exp(-1.*(self.steps_done/self.eps_decay))
+        return (self.steps_done)*((self.eps_end - self.eps_start)/(self.eps_decay)) + self.eps_start
+
+    def select_action(self, state, train):
+        # state holds one stacked state per environment, a single forward pass picks all the actions
+        num_states = state.size(0)
+        if train:
+            self.steps_done += num_states
+        # action will be selected based on the policy type : greedy or epsilon-greedy
+        if self.eps_greedy:
+            if train:
+                eps_threshold = self.epsilon
+            else:
+                eps_threshold = 0.05
+            # explore or exploit?
+            explore = np.random.rand(num_states) <= eps_threshold
+            if explore.all():
+                return torch.randint(self.n_actions, (num_states,), device=device)
+            with torch.no_grad():
+                action = self.model(state.float().div_(255)).max(1)[1]
+            if explore.any():
+                explore = torch.from_numpy(explore).to(device)
+                action[explore] = torch.randint(self.n_actions, (int(explore.sum()),), device=device)
+            return action
+        else:
+            with torch.no_grad():
+                action = self.model(state.float().div_(255))
+            return action.max(1)[1]
+
+    def reset(self):
+        """Start new episodes in all the environments, returns their first observations"""
+        observations = self.envs.reset()
+        self.reset_envs(observations)
+        self.n_step_returns.reset()
+        self.episode_steps[:] = 0
+        self.episode_rewards[:] = 0
+        return observations
+
+    def reset_envs(self, observations, index=None):
+        """Start the stacks of new episodes, index selects the environments that were reset"""
+        frames = self.pre_process.reset(observations, index)
+        self.frame_stack.reset(torch.from_numpy(frames), self.memory.store_frames(frames), index)
+
+    def env_step(self, actions):
+        """Step all the environments and store the transitions in memory, returns rewards and dones"""
+        state_ids = self.frame_stack.ids().copy()
+        actions = actions.cpu().numpy()
+        with self.metrics.time('env_step'):
+            observations, rewards, dones, infos = self.envs.step(actions)
+        # finished environments were reset, their next state ends with the last frame of the episode
+        last_observations = observations
+        if dones.any():
+            last_observations = observations.copy()
+            for i in np.flatnonzero(dones):
+                last_observations[i] = infos[i]['terminal_observation']
+        with self.metrics.time('pre_process'):
+            frames = self.pre_process(last_observations)
+        with self.metrics.time('replay_push'):
+            self.frame_stack.push(torch.from_numpy(frames), self.memory.store_frames(frames))
+            transitions = self.n_step_returns.add(state_ids, actions, rewards, self.frame_stack.ids().copy(), dones)
+            if transitions is not None:
+                self.memory.store_transitions(*transitions)
+        if dones.any():
+            self.reset_envs(observations[dones], dones)
+        return rewards, dones
+
+    def step(self, train=True):
+        """Play one step in every environment, returns (env index, total reward, steps) of the episodes that ended"""
+        with self.metrics.time('select_action'):
+            action = self.select_action(self.frame_stack.state(), train)
+        # the transitions are stored in memory and the terminal environments reset
+        reward, is_terminal = self.env_step(action)
+        self.episode_steps += 1
+        self.episode_rewards += reward
+        finished = [(i, self.episode_rewards[i], self.episode_steps[i]) for i in np.flatnonzero(is_terminal)]
+        self.episode_steps[is_terminal] = 0
+        self.episode_rewards[is_terminal] = 0
+        return finished
+
+################################################################################################################################################
+### Asynchronous training: actor processes play the game while the learner keeps training on the replay memory
+
+class ExperienceSender(object):
+    """Takes the place of the replay memory in an actor process.
+
+    Frames get ids local to the actor, they are sent together with the transitions referring to them
+    to the learner once per step by flush.
+    """
+
+    def __init__(self, queue, actor_index, stop):
+        self.queue = queue
+        self.actor_index = actor_index
+        self.stop = stop
+        self.num_frames = 0
+        self.ops = []
+
+    def store_frames(self, frames):
+        ids = self.num_frames + np.arange(len(frames))
+        self.num_frames += len(frames)
+        self.ops.append(('frames', frames, ids[0]))
+        return ids
+
+    def store_transitions(self, state_ids, actions, rewards, next_state_ids, dones, discounts):
+        self.ops.append(('transitions', state_ids, actions, rewards, next_state_ids, dones, discounts))
+
+    def flush(self, episodes, env_steps=0):
+        """Send the experience of the env_steps environment steps since the last flush and the (total reward, steps)
+        of finished episodes, the n-step returns hold some transitions back so the steps are counted apart"""
+        message = (self.actor_index, self.ops, episodes, env_steps)
+        self.ops = []
+        while not self.stop.is_set():
+            try:
+                self.queue.put(message, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+class ExperienceReceiver(object):
+    """Stores the experience sent by one actor in the replay memory, translating its frame ids"""
+
+    def __init__(self, memory, num_envs, frame_hist_len, n_step=1):
+        self.memory = memory
+        # the transitions only refer to the frames of the current stacks and n-step windows, at most two frames
+        # (the new one and the one of a reset) per environment and step over the last frame_hist_len + n_step steps
+        self.id_map = np.zeros(4*num_envs*(frame_hist_len+n_step), dtype=np.int64)
+
+    def ingest(self, ops):
+        """Store the experience of a message"""
+        n = len(self.id_map)
+        for op in ops:
+            if op[0] == 'frames':
+                _, frames, first_id = op
+                self.id_map[(first_id + np.arange(len(frames))) % n] = self.memory.store_frames(frames)
+            else:
+                _, state_ids, actions, rewards, next_state_ids, dones, discounts = op
+                self.memory.store_transitions(self.id_map[state_ids % n], actions, rewards,
+                                              self.id_map[next_state_ids % n], dones, discounts)
+
+def _actor_process(args, actor_index, experience_queue, shared_model, weights_lock, weights_version, stop, steps_done):
+    # the actors share the cores, one thread each, and step their environments in process
+    torch.set_num_threads(1)
+    args = argparse.Namespace(**dict(vars(args), vec_env='sync'))
+    np.random.seed(args.seed + actor_index + 1)
+    torch.manual_seed(args.seed + actor_index + 1)
+
+    # the learner stops reading the queue once stop is set, the experience still buffered for it is dropped
+    # instead of keeping the process from exiting
+    experience_queue.cancel_join_thread()
+    sender = ExperienceSender(experience_queue, actor_index, stop)
+    actor = Actor(args, memory=sender, env_offset=(actor_index + 1)*args.num_envs)
+    actor.model = make_model(args, actor.n_in, actor.n_actions).to(device)
+    # all the actors together follow the epsilon schedule of a single one, from the steps the learner resumed at
+    actor.eps_decay = args.eps_decay / args.num_actors
+    actor.steps_done = steps_done // args.num_actors
+    version = -1
+    try:
+        actor.reset()
+        sender.flush([])
+        while not stop.is_set():
+            # pick up the weights published by the learner
+            if weights_version.value != version:
+                with weights_lock:
+                    version = weights_version.value
+                    actor.model.load_state_dict(shared_model.state_dict())
+            finished = actor.step(train=True)
+            sender.flush([(total_reward, steps) for _, total_reward, steps in finished], actor.num_envs)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        actor.envs.close()
+
+################################################################################################################################################
+### Evaluation: many episodes in parallel with batched inference and nothing written to the replay memory
+
+def return_statistics(returns, seconds, frames):
+    """Mean, median, standard deviation and 95% confidence interval of the mean of the episode returns"""
+    returns = np.asarray(returns, dtype=np.float64)
+    stdev = returns.std(ddof=1) if len(returns) > 1 else 0.
+    # normal approximation of the distribution of the mean
+    half_width = 1.96 * stdev / math.sqrt(len(returns))
+    return {'episodes': len(returns), 'mean': returns.mean(), 'median': float(np.median(returns)),
+            'stdev': stdev, 'ci95': (returns.mean() - half_width, returns.mean() + half_width),
+            'min': returns.min(), 'max': returns.max(), 'frames_per_sec': frames / seconds}
+
+def evaluate(args, model, num_episodes, num_envs, epsilon=0.05, env_offset=0):
+    """Play num_episodes episodes of the epsilon-greedy policy of model over num_envs environments.
+
+    All the environments are stepped after a single forward pass, returns the return_statistics.
+    """
+    num_envs = max(1, min(num_envs, num_episodes))
+    envs = make_vector_env(args.env, num_envs, args.vec_env, env_offset)
+    n_actions = envs.action_space.n
+    pre_process = FramePreprocessor(max_pool=args.max_pool)
+    frame_stack = FrameStack(num_envs, args.frame_hist_len)
+    # frame ids only matter to the replay memory
+    no_ids = np.zeros(num_envs, dtype=np.int64)
+    # every environment plays its share of the episodes, stopping at the first num_episodes episodes would favour the short ones
+    quota = np.full(num_envs, num_episodes // num_envs)
+    quota[:num_episodes % num_envs] += 1
+    episode_rewards = np.zeros(num_envs)
+    returns = []
+    frames = 0
+    start = time.perf_counter()
+    try:
+        observations = envs.reset()
+        frame_stack.reset(torch.from_numpy(pre_process.reset(observations)), no_ids)
+        while quota.any():
+            with torch.inference_mode():
+                actions = model(frame_stack.state().float().div_(255)).max(1)[1].cpu().numpy()
+            explore = np.random.rand(num_envs) <= epsilon
+            actions[explore] = np.random.randint(n_actions, size=int(explore.sum()))
+            observations, rewards, dones, infos = envs.step(actions)
+            frames += int(np.count_nonzero(quota))
+            episode_rewards += rewards
+            frame_stack.push(torch.from_numpy(pre_process(observations)), no_ids)
+            if dones.any():
+                for i in np.flatnonzero(dones & (quota > 0)):
+                    returns.append(episode_rewards[i])
+                    quota[i] -= 1
+                episode_rewards[dones] = 0
+                frame_stack.reset(torch.from_numpy(pre_process.reset(observations[dones], dones)), no_ids[dones], dones)
+    finally:
+        envs.close()
+    return return_statistics(returns, time.perf_counter() - start, frames)
+
+def _evaluate_checkpoint(args, path, num_threads):
+    # the workers share the cores
+    torch.set_num_threads(num_threads)
+    np.random.seed(args.seed)
+    env = make_env(args.env)
+    n_actions = env.action_space.n
+    env.close()
+    model = make_model(args, args.frame_hist_len*84*84, n_actions).to(device)
+    model.load_state_dict(torch.load(path, map_location=device)['model_state_dict'])
+    return path, evaluate(args, make_policy(args, model), args.eval_episodes, args.eval_envs, args.eval_eps)
+
+def evaluate_checkpoints(args):
+    """Evaluate a model file, or every model file of a directory with eval_workers processes"""
+    if os.path.isdir(args.evaluate):
+        paths = glob.glob(os.path.join(args.evaluate, '*.pt'))
+        # model_trained_{epoch}.pt in epoch order
+        paths.sort(key=lambda path: [int(part) if part.isdigit() else part for part in re.split(r'(\d+)', path)])
+    else:
+        paths = [args.evaluate]
+    if not paths:
+        raise FileNotFoundError(f'no .pt files in {args.evaluate}')
+    num_workers = min(len(paths), args.eval_workers or os.cpu_count())
+    num_threads = max(1, torch.get_num_threads() // num_workers)
+    if num_workers == 1:
+        results = [_evaluate_checkpoint(args, path, torch.get_num_threads()) for path in paths]
+    else:
+        # the workers are not daemonic, a subproc vector env can start its own processes
+        with concurrent.futures.ProcessPoolExecutor(num_workers, mp_context=mp.get_context('spawn')) as pool:
+            results = list(pool.map(_evaluate_checkpoint, [args]*len(paths), paths, [num_threads]*len(paths)))
+
+    print("{:<48} {:>9} {:>9} {:>9} {:>21} {:>10}".format('checkpoint', 'mean', 'median', 'stdev', 'ci95', 'frames/s'))
+    for path, stats in results:
+        print("{:<48} {:>9.2f} {:>9.2f} {:>9.2f} {:>10.2f},{:>10.2f} {:>10.0f}".format(
+            path, stats['mean'], stats['median'], stats['stdev'], *stats['ci95'], stats['frames_per_sec']))
+    best_path, best = max(results, key=lambda result: result[1]['mean'])
+    print("Best checkpoint {} with a mean return of {:.2f} over {} episodes".format(best_path, best['mean'], best['episodes']))
+    return results
+
+################################################################################################################################################
+### Serving policy: the trained network prepared for acting, quantized and compiled for the cpu
+
+class ServingPolicy(nn.Module):
+    """Runs the optimized network on the states moved to its device and memory format"""
+
+    def __init__(self, net, policy_device, memory_format=torch.contiguous_format):
+        super(ServingPolicy, self).__init__()
+        self.net = net
+        self.device = policy_device
+        self.memory_format = memory_format
+
+    def forward(self, x):
+        return self.net(x.to(self.device).contiguous(memory_format=self.memory_format))
+
+def random_play_states(args, num_states=256):
+    """Stacked states of num_states steps of random play, scaled to [0,1]"""
+    envs = make_vector_env(args.env, 1)
+    pre_process = FramePreprocessor(max_pool=args.max_pool)
+    frame_stack = FrameStack(1, args.frame_hist_len)
+    no_ids = np.zeros(1, dtype=np.int64)
+    frame_stack.reset(torch.from_numpy(pre_process.reset(envs.reset())), no_ids)
+    states = []
+    for _ in range(num_states):
+        observations, _, dones, _ = envs.step(np.random.randint(envs.action_space.n, size=1))
+        frame_stack.push(torch.from_numpy(pre_process(observations)), no_ids)
+        if dones.any():
+            frame_stack.reset(torch.from_numpy(pre_process.reset(observations)), no_ids)
+        states.append(frame_stack.state().clone())
+    envs.close()
+    return torch.cat(states).float().div_(255)
+
+def make_policy(args, model, calibration_states=None):
+    """A copy of model for acting only, quantized, channels-last, traced or compiled as set by args.
+
+    The quantized networks run on the cpu, static quantization is calibrated on calibration_states
+    (states of random play by default).
+    """
+    if args.inference not in ('eager', 'trace', 'compile'):
+        raise ValueError(f'inference should be eager, trace or compile, got {args.inference}')
+    if args.quantize not in ('none', 'dynamic', 'static'):
+        raise ValueError(f'quantize should be none, dynamic or static, got {args.quantize}')
+    net = copy.deepcopy(model).eval()
+    net.requires_grad_(False)
+    policy_device = device
+    if args.quantize != 'none':
+        # int8 kernels only exist for the cpu
+        policy_device = torch.device('cpu')
+        net = net.to(policy_device)
+
+    # the convolutions are faster on NHWC inputs
+    memory_format = torch.contiguous_format
+    if args.channels_last and any(isinstance(m, nn.Conv2d) for m in net.modules()):
+        memory_format = torch.channels_last
+        net = net.to(memory_format=memory_format)
+
+    if args.quantize == 'dynamic':
+        # int8 weights for the fully connected layers, their inputs are quantized on the fly
+        net = torch.ao.quantization.quantize_dynamic(net, {nn.Linear}, dtype=torch.qint8)
+    elif args.quantize == 'static':
+        # convolutions and fully connected layers in int8, the activation ranges are observed on calibration states
+        from torch.ao.quantization import get_default_qconfig_mapping
+        from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+        if calibration_states is None:
+            calibration_states = random_play_states(args)
+        calibration_states = calibration_states.to(policy_device).contiguous(memory_format=memory_format)
+        net = prepare_fx(net, get_default_qconfig_mapping(torch.backends.quantized.engine), (calibration_states[:1],))
+        with torch.no_grad():
+            net(calibration_states)
+        net = convert_fx(net)
+
+    if args.inference == 'trace':
+        example = torch.zeros((1, args.frame_hist_len, 84, 84), device=policy_device).contiguous(memory_format=memory_format)
+        with torch.no_grad():
+            net = torch.jit.freeze(torch.jit.trace(net, example))
+    elif args.inference == 'compile':
+        net = torch.compile(net)
+    return ServingPolicy(net, policy_device, memory_format)
+
+def benchmark_inference(args, model, states, min_time, batch_size=32):
+    """Latency of a single action and states/sec of batched actions of the eager and optimized policies"""
+    variants = {'eager': {}, 'channels_last': {'channels_last': 1}, 'trace': {'inference': 'trace'},
+                'compile': {'inference': 'compile'}, 'dynamic int8': {'quantize': 'dynamic'},
+                'static int8': {'quantize': 'static'}, 'static int8 trace': {'quantize': 'static', 'inference': 'trace'}}
+    defaults = {'inference': 'eager', 'quantize': 'none', 'channels_last': 0}
+    results = {}
+    for name, options in variants.items():
+        policy_args = argparse.Namespace(**dict(vars(args), **dict(defaults, **options)))
+        try:
+            policy = make_policy(policy_args, model, states)
+            with torch.inference_mode():
+                single = ops_per_sec(lambda: policy(states[:1]), min_time)
+                batched = ops_per_sec(lambda: policy(states[:batch_size]), min_time)
+        except Exception as error: # torch.compile needs a working c++ compiler for instance
+            results[name] = {'error': str(error).splitlines()[0]}
+            continue
+        results[name] = {'latency_ms': 1000 / single, f'states_per_sec_batch_{batch_size}': batch_size * batched}
+    return results
+
+################################################################################################################################################
+### Episode videos and plots that keep the training loop off the disk and the display
+
+class VideoRecorder(object):
+    """Writes the episode videos in a background thread, the training loop only queues the raw frames.
+
+    When the writer falls max_frames behind the frames are dropped rather than waited for.
+    """
+
+    def __init__(self, fps=15, max_frames=256):
+        self.fps = fps
+        self.queue = queue.Queue(maxsize=max_frames)
+        self.thread = None
+        self.recording = False
+        self.dropped_frames = 0
+
+    def start(self, path):
+        """Start a new video, the frame size is taken from its first frame"""
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._write_videos, daemon=True)
+            self.thread.start()
+        self.end()
+        self.queue.put(('start', path))
+        self.recording = True
+
+    def write(self, frame):
+        if not self.recording:
+            return
+        try:
+            # the environments overwrite their observations, queue a copy
+            self.queue.put_nowait(('frame', np.array(frame)))
+        except queue.Full:
+            self.dropped_frames += 1
+
+    def end(self):
+        if self.recording:
+            self.queue.put(('end', None))
+            self.recording = False
+
+    def close(self):
+        if self.thread is None:
+            return
+        self.end()
+        self.queue.put(('close', None))
+        self.thread.join()
+        self.thread = None
+        if self.dropped_frames > 0:
+            print("Video recording dropped {} frames".format(self.dropped_frames))
+
+    def _write_videos(self):
+        path, out = None, None
+        while True:
+            kind, data = self.queue.get()
+            if kind == 'frame' and path is not None:
+                if out is None:
+                    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+                    height, width = data.shape[:2]
+                    out = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'DIVX'), self.fps, (width, height))
+                # the observations are RGB, opencv writes BGR
+                out.write(cv2.cvtColor(data, cv2.COLOR_RGB2BGR))
+                continue
+            if out is not None:
+                out.release()
+            path, out = None, None
+            if kind == 'start':
+                path = data
+            elif kind == 'close':
+                return
+
+class RunningMean(object):
+    """Mean of the last window values, updated in constant time per value.
+
+    means keeps the mean after every value from the first full window on.
+    """
+
+    def __init__(self, window=100):
+        self.values = deque(maxlen=window)
+        self.total = 0.
+        self.means = []
+
+    @property
+    def full(self):
+        return len(self.values) == self.values.maxlen
+
+    def add(self, value):
+        if self.full:
+            self.total -= self.values[0]
+        self.values.append(value)
+        self.total += value
+        mean = self.total / len(self.values)
+        if self.full:
+            self.means.append(mean)
+        return mean
+
+################################################################################################################################################
+
+class NullWriter(object):
+    """Takes the place of the SummaryWriter on the distributed ranks that do not log"""
+    logdir = None
+
+    def add_scalar(self, *args, **kwargs):
+        pass
+
+    def close(self):
+        pass
+
 class Agent(object):
     def __init__(self, args, render=False):
-        self.env = gym.make(args.env)
-        # self.env = gym.wrappers.Monitor(self.env, directory='monitors/'+args.env, force=True)
-        n_in = self.env.observation_space.shape[0]
-        ##TODO change code location and correct it back to the shape after preprocessing
-        if len(self.env.observation_space.shape)==3: # observation is an image
-            in_weight=self.env.observation_space.shape[0]
-            in_height=self.env.observation_space.shape[1]
-            in_channel = self.env.observation_space.shape[2]
-            n_in = in_weight*in_height*in_channel
-
-        n_out = self.env.action_space.n
+        self.args = args
+        # data-parallel learner: every rank (process) has its own environments and replay memory,
+        # the gradients are averaged over the ranks and only rank 0 logs and saves
+        self.rank, self.world_size = 0, 1
+        if dist.is_available() and dist.is_initialized():
+            self.rank, self.world_size = dist.get_rank(), dist.get_world_size()
+            if args.num_actors > 0:
+                raise ValueError('distributed training does not support actor processes')
+        self.actor = Actor(args, env_offset=self.rank*args.num_envs)
+        self.envs = self.actor.envs
+        self.num_envs = args.num_envs
+        n_in = self.actor.n_in
+        self.n_actions = self.actor.n_actions
+        n_out = self.n_actions
         self.batch_size = args.batch_size
         self.game_name = args.env
         self.record_video = args.record_video
+        self.recorder = VideoRecorder()
+        # 'window' draws the plots on screen, 'png' saves them every plot_every episodes and 'none' leaves them to tensorboard
+        if args.plot not in ('window', 'png', 'none'):
+            raise ValueError(f'plot should be window, png or none, got {args.plot}')
+        self.plot = args.plot
+        self.plot_every = args.plot_every
+        self.duration_plot = None
         self.save_model_every_epoch = args.save_model_every_epoch
+        if self.rank != 0:
+            self.record_video = 0
+            self.plot = 'none'
+            self.save_model_every_epoch = 0
 
         # Check if the folder exist to save the model dict
         if not os.path.exists(f'saved_models/{self.game_name}'):
             os.makedirs(f'saved_models/{self.game_name}')
 
         # writer to write data to tensorboard
-        self.writer = SummaryWriter()
-
-        # type of function approximator to use
-        if args.model_type == 'CNN_2c2f':        
-            self.model = CNN_2c2f().to(device)
-        elif args.model_type == 'linear':
-            self.model = LinearQN(n_in, n_out).to(device)
-        elif args.model_type == 'dqn':
-            self.model = DQN(n_in, args.n_hidden, n_out).to(device)
-        else:
-            self.model = DuelingDQN(n_in, args.n_hidden, n_out).to(device)
-
+        self.writer = SummaryWriter(args.run_dir or None) if self.rank == 0 else NullWriter()
+        # stage timings and training values, flushed to tensorboard every metrics_every steps
+        self.metrics = TrainingMetrics(self.writer if args.metrics_every > 0 and self.rank == 0 else None, args.metrics_every, args.profile)
+
+        self.model = make_model(args, n_in, n_out).to(device)
+        self.actor.model = self.model
+        self.actor.metrics = self.metrics
+
+        # target network: 'none' bootstraps from the online network, 'hard:N' copies the online
+        # weights every N updates and 'soft:tau' moves the target weights by tau after every update
+        kind, _, value = args.target_update.partition(':')
+        if kind not in ('none', 'hard', 'soft') or (kind != 'none' and not value):
+            raise ValueError(f'target_update should be none, hard:N or soft:tau, got {args.target_update}')
+        self.target_update = kind
+        self.target_model = None
+        if kind != 'none':
+            self.target_update_every = int(value) if kind == 'hard' else 1
+            self.target_tau = float(value) if kind == 'soft' else 1.
+            if self.target_update_every < 1 or not 0 < self.target_tau <= 1:
+                raise ValueError(f'target_update needs N >= 1 for hard:N and 0 < tau <= 1 for soft:tau, got {args.target_update}')
+            self.target_model = copy.deepcopy(self.model)
+            self.target_model.requires_grad_(False)
+        if args.double_dqn and self.target_model is None:
+            raise ValueError('double_dqn needs a target network, set target_update to hard:N or soft:tau')
+        self.double_dqn = args.double_dqn
+        self.num_updates = 0
+
+        # every environment of the actor processes writes to the memory as well
+        num_envs = self.num_envs*(args.num_actors + 1)
+        # the replay memory lives in RAM or, with a replay_dir, in memory mapped files
+        replay_dir = args.replay_dir or None
+        checkpoint_dir = args.checkpoint_dir or f'saved_models/{self.game_name}/checkpoint'
+        if replay_dir is not None and os.path.realpath(replay_dir) == os.path.realpath(checkpoint_dir):
+            # the memory truncates its files when it is created, the checkpoint could not be resumed
+            raise ValueError('replay_dir and checkpoint_dir should be different directories')
         # should experience replay be used
         if args.exp_replay:
             self.exp_replay = True
-            self.memory = ReplayMemory(args.buffer_size)
+            if args.replay == 'prioritized':
+                self.memory = PrioritizedReplayMemory(args.buffer_size, args.frame_hist_len, num_envs=num_envs, directory=replay_dir, n_step=args.n_step,
+                                                      alpha=args.alpha, beta=args.beta, beta_steps=args.beta_steps)
+            else:
+                self.memory = ReplayMemory(args.buffer_size, args.frame_hist_len, num_envs=num_envs, directory=replay_dir, n_step=args.n_step)
         else:
             # memory of size 1 is same as using only the immediate transitions
             # this is only to keep the overall api similar for all cases
-            self.memory = ReplayMemory(1)
+            self.memory = ReplayMemory(1, args.frame_hist_len, num_envs=num_envs, n_step=args.n_step)
             assert self.batch_size == 1
+        self.actor.memory = self.memory
+        # batches sampled ahead by a background thread
+        self.prefetcher = None
+        if args.replay_prefetch > 0:
+            self.prefetcher = BatchPrefetcher(self.memory, self.batch_size, args.replay_prefetch)
 
-        # policy type
-        if args.eps_greedy:
-            self.eps_greedy = True
-            self.eps_start = args.eps_start
-            self.eps_end = args.eps_end
-            self.eps_decay = args.eps_decay
-        else:
-            self.eps_greedy = False
-
-        if args.optimizer == 'rmsprop':
-            self.optimizer = optim.RMSprop(self.model.parameters())
-        else:
-            self.optimizer = optim.Adam(self.model.parameters(), lr=args.lr)
+        self.optimizer = make_optimizer(args, self.model.parameters())
+        self.amp = args.amp
+        self.grad_scaler = make_grad_scaler(args)
+        self.grad_clip = args.grad_clip
 
-        self.gamma = args.gamma
         self.num_episodes = args.num_episodes
         self.loss_fn = args.loss_fn
-        self.steps_done = 0
+        # gradient updates per environment step, the fraction left over is carried to the next step
+        self.replay_ratio = args.replay_ratio
+        self.pending_updates = 0.
+        self.num_actors = args.num_actors
+        self.weight_sync_every = args.weight_sync_every
         self.episode_durations = []
+        # total rewards of the training episodes played since the agent was created
+        self.episode_rewards = []
+        # mean duration of the last 100 episodes
+        self.duration_mean = RunningMean(100)
         self.avg_rewards = []
         self.memory_burn_limit = args.memory_burn_limit
+        self.episodes_done = 0
 
         if args.load_pretrained_model:
             # load the previous trained agent
-            checkpoint = torch.load(args.model_path)
-            self.model.load_stae_dict(checkpoint(['model_state_dict']))
-            self.optimizer.load_state_dict(checkpoint(['optimizer_state_dict']))
-        
-        
-
-    def select_action(self, state, train):
-        if train:
-            self.steps_done += 1
-        # action will be selected based on the policy type : greedy or epsilon-greedy
-        if self.eps_greedy:
-            # smoothly decaying the epsilon threshold value as we progress
-            if train:
-                # eps_threshold = self.eps_end + (self.eps_start - self.eps_end) * math.exp(-1.*(self.steps_done/self.eps_decay))
-                eps_threshold = (self.steps_done)*((self.eps_end - self.eps_start)/(self.eps_decay)) + self.eps_start
-            else:
-                eps_threshold = 0.05
-            # explore or exploit?
-            if random.random() > eps_threshold:
-                with torch.no_grad():
-                    action = self.model(state[None,:])
-                return action.data.max(1)[1].view(1,1)
-            else:
-                return torch.tensor([[random.randrange(self.env.action_space.n)]],device = device, dtype=torch.long)
+            checkpoint = torch.load(args.model_path, map_location=device)
+            self.model.load_state_dict(checkpoint['model_state_dict'])
+            self.optimizer.load_state_dict(checkpoint['optimizer_state_dict'])
+            self.reset_target_model()
+
+        # resumable checkpoints of the whole training state, replay memory included
+        self.checkpoint_every = args.checkpoint_every if self.rank == 0 else 0
+        self.checkpointer = Checkpointer(checkpoint_dir)
+        self.resumed = False
+        if args.resume and self.checkpointer.exists():
+            self.load_checkpoint()
+
+        # the gradient updates go through DistributedDataParallel, which starts all the ranks from the
+        # weights of rank 0 and all-reduces the gradients during backward
+        self.learner_model = self.model
+        if self.world_size > 1:
+            self.learner_model = DistributedDataParallel(self.model, broadcast_buffers=False)
+            # the target networks were copied from the weights of every rank, they start from rank 0 as well
+            if self.target_model is not None:
+                for tensor in self.target_model.state_dict().values():
+                    dist.broadcast(tensor, 0)
+
+    @property
+    def steps_done(self):
+        return self.actor.steps_done
+
+    def save_checkpoint(self):
+        state = {
+            'episodes_done': self.episodes_done,
+            'steps_done': self.steps_done,
+            'num_updates': self.num_updates,
+            'pending_updates': self.pending_updates,
+            'episode_durations': self.episode_durations,
+            'model_state_dict': self.model.state_dict(),
+            'optimizer_state_dict': self.optimizer.state_dict(),
+            'grad_scaler_state_dict': self.grad_scaler.state_dict(),
+            'target_model_state_dict': self.target_model.state_dict() if self.target_model is not None else None,
+            'rng_state': {
+                'random': random.getstate(),
+                'numpy': np.random.get_state(),
+                'torch': torch.get_rng_state(),
+                'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None,
+            },
+        }
+        # the training goes on while the checkpoint is written
+        self.checkpointer.save(copy.deepcopy(state), self.memory)
+
+    def load_checkpoint(self):
+        # all the ranks resume from the checkpoint of rank 0, the other ranks fill a new replay memory
+        state, memory_loaded = self.checkpointer.load(self.memory if self.rank == 0 else None)
+        self.episodes_done = state['episodes_done']
+        self.actor.steps_done = state['steps_done']
+        self.num_updates = state['num_updates']
+        self.pending_updates = state['pending_updates']
+        self.episode_durations = state['episode_durations']
+        self.duration_mean = RunningMean(100)
+        for steps in self.episode_durations:
+            self.duration_mean.add(steps)
+        self.model.load_state_dict(state['model_state_dict'])
+        self.optimizer.load_state_dict(state['optimizer_state_dict'])
+        if state.get('grad_scaler_state_dict'):
+            self.grad_scaler.load_state_dict(state['grad_scaler_state_dict'])
+        if self.target_model is not None and state['target_model_state_dict'] is not None:
+            self.target_model.load_state_dict(state['target_model_state_dict'])
         else:
-            with torch.no_grad():
-               action = action = self.model(state[None,:])
-            return action.data.max(1)[1].view(1,1)
+            # the checkpoint was trained without a target network
+            self.reset_target_model()
+        # the other ranks keep their own random streams
+        rng_state = state['rng_state']
+        if self.rank == 0:
+            random.setstate(rng_state['random'])
+            np.random.set_state(rng_state['numpy'])
+            torch.set_rng_state(rng_state['torch'])
+            if rng_state['cuda'] is not None and torch.cuda.is_available():
+                torch.cuda.set_rng_state_all(rng_state['cuda'])
+        # without its replay memory the training resumes by filling the memory again
+        self.resumed = memory_loaded
+        print("Resumed from episode {} after {} steps".format(self.episodes_done, self.steps_done))
 
     # Here we'll deal with the empty memory problem: we pre-populate our memory by taking random actions 
     # and storing the experience (state, action, reward, next_state).
     def burn_memory(self):
 
         steps = 0
-        state = torch.zeros(4,84,84, device = device)
-        next_state = torch.zeros(4,84,84, device =device)
-
-        state_single = self.env.reset()
-        #state_single = rgb2gray(resize(state_single,(84,84)))
-        state_single = pre_process(state_single)
-
-        state[0,:,:] = state_single
-        state[1,:,:] = state_single
-        state[2,:,:] = state_single
-        state[3,:,:] = state_single
-    
+        self.actor.reset()
 
         print('Starting to fill the memory with random policy')
-        while steps < self.memory_burn_limit:
+        # every update needs a full batch, distributed ranks must never skip one
+        while steps < self.memory_burn_limit or len(self.memory) < self.batch_size:
             #Executing a random policy
-            action = torch.tensor([[random.randrange(self.env.action_space.n)]], device=device, dtype=torch.long)
-            next_state_single, reward, is_terminal, _ = self.env.step(action)   
-            reward = torch.tensor([reward], device = device)             
-            #next_state_single = rgb2gray(resize(next_state_single,(84,84))) 
-            next_state_single = pre_process(next_state_single)
-
-            next_state[0,:,:] = state[1,:,:]
-            next_state[1,:,:] = state[2,:,:]
-            next_state[2,:,:] = state[3,:,:]
-            next_state[3,:,:] = next_state_single
-
-            # Store the transition in memory
-            self.memory.push(state, action, next_state, reward)
-
-            # Move to next step
-            steps += 1
-            state = next_state
-
-            #If the next_state is terminal, then you reset it
-            if is_terminal:
-                state_single = self.env.reset()
-                #state_single = rgb2gray(resize(state_single,(84,84)))
-                state_single = pre_process(state_single)
-
-                state[0,:,:] = state_single
-                state[1,:,:] = state_single
-                state[2,:,:] = state_single
-                state[3,:,:] = state_single
-                    
+            action = torch.randint(self.n_actions, (self.num_envs,))
+            # the transitions are stored in memory and the terminal environments reset
+            self.actor.env_step(action)
+            steps += self.num_envs
+
         print('Memory filled, ready to start training now')
         print("-"*50)
 
 ################################################################################################################################################
     def testing_random_play(self):
 
-        state = self.env.reset()
+        state = self.envs.reset()
         #state is 210,160,3            
 
         for i in range(1000):
-            action = random.randrange(self.env.action_space.n)
-            next_state, reward, is_terminal, _ = self.env.step(action)
+            action = np.random.randint(self.n_actions, size=self.num_envs)
+            next_state, reward, is_terminal, _ = self.envs.step(action)
             print(reward,is_terminal)
-            self.env.render()
+            self.envs.render()
         print('Random play done now')
         
 ################################################################################################################################################
 
-    def play_episode(self, e, train=True):
-
-        state_single = self.env.reset()
-        size = (state_single.shape[0],state_single.shape[1])
-        if self.record_video >0 and e%self.record_video == 0:
-            out = cv2.VideoWriter(f'played_out/{self.game_name}/project_{e}.avi',cv2.VideoWriter_fourcc(*'DIVX'), 15, size)
+    def play_episodes(self, num_episodes, train=True, first_episode=0):
+        """Play num_episodes episodes spread over all the environments, returns their total rewards"""
+        if num_episodes <= 0:
+            return []
+        self.actor.reset()
 
-        state_single = pre_process(state_single)
-            
-        state = torch.zeros(4,84,84,device = device)
-        next_state = torch.zeros(4,84,84,device = device)
+        # index of the episode played by every environment and of the next one to start
+        episode = list(range(first_episode, first_episode + self.num_envs))
+        next_episode = first_episode + self.num_envs
+        episode_rewards = []
 
-        state[0,:,:] = state_single
-        state[1,:,:] = state_single
-        state[2,:,:] = state_single
-        state[3,:,:] = state_single
+        # only the episodes of the first environment are recorded, from its raw observations
+        def start_recording(e):
+            if self.record_video >0 and e%self.record_video == 0:
+                self.recorder.start(f'played_out/{self.game_name}/project_{e}.avi')
+        start_recording(episode[0])
 
-        steps = 0
-        total_reward = 0
-        # iterate till the terminal state is reached
+        # iterate till enough episodes reached their terminal state
         while True:
-            if self.record_video >0 and e%self.record_video == 0:
-                out.write(self.env.render('rgb_array'))
-                
+            self.recorder.write(self.envs.observations[0])
+
             #self.env.render(mode='rgb_array')
-            action = self.select_action(state,train)
-            # print("action: ", action)
-            next_state_single, reward, is_terminal, _ = self.env.step(action)
-            reward = torch.tensor([reward], device = device)
-            #next_state_single = rgb2gray(resize(next_state_single,(84,84))) 
-            next_state_single = pre_process(next_state_single)
-            next_state[0,:,:] = state[1,:,:]
-            next_state[1,:,:] = state[2,:,:]
-            next_state[2,:,:] = state[3,:,:]
-            next_state[3,:,:] = next_state_single
-
-            total_reward += reward
-
-            # store the transition in memory
-            self.memory.push(state, action, next_state, reward)
-            if is_terminal:
-                self.writer.add_scalar('total_reward/train', total_reward, e)
-                self.writer.add_scalar('episode_duration/train', steps, e)
-                self.episode_durations.append(steps)
-                print("Episode {} completed after {} steps | Total steps = {} | Total reward = {}".format(e,steps,self.steps_done, total_reward.item()))
-                if self.record_video >0 and e%self.record_video == 0:
-                    out.release()
-                self.plot_durations()
-                # self.plot_rewards()  
-                return total_reward
+            for i, total_reward, steps in self.actor.step(train):
+                if i == 0:
+                    self.recorder.end()
+                if len(episode_rewards) >= num_episodes:
+                    # a rank done with its episodes only keeps stepping and learning for the other ranks
+                    continue
+                self.end_of_episode(episode[i], total_reward, steps, train)
+                episode_rewards.append(total_reward)
+                if len(episode_rewards) >= num_episodes and self.world_size == 1:
+                    self.recorder.end()
+                    return episode_rewards
+                episode[i] = next_episode
+                next_episode += 1
+                if i == 0:
+                    start_recording(episode[0])
 
             if train:
                 # backprop and learn; otherwise just play the policy
-                self.optimize_model()
-                
-            # update state
-            state = next_state
-            steps += 1  
+                self.learn(self.num_envs)
+                self.record_metrics(self.num_envs)
+
+            if self.world_size > 1 and self.all_ranks_done(len(episode_rewards) >= num_episodes):
+                self.recorder.end()
+                return episode_rewards
+
+    def all_ranks_done(self, done):
+        # every gradient all-reduce needs all the ranks, they keep stepping and learning in lockstep
+        # until every one of them has played its episodes
+        flag = torch.tensor([int(done)])
+        dist.all_reduce(flag, op=dist.ReduceOp.MIN)
+        return bool(flag.item())
+
+    def learn(self, env_steps):
+        """Run the gradient updates owed for env_steps environment steps under the replay ratio"""
+        self.pending_updates += self.replay_ratio * env_steps
+        while self.pending_updates >= 1:
+            self.optimize_model()
+            self.pending_updates -= 1
+
+    def record_metrics(self, env_steps):
+        if self.actor.eps_greedy:
+            self.metrics.add('epsilon', self.actor.epsilon)
+        self.metrics.add('replay_fill', len(self.memory) / self.memory.capacity)
+        self.metrics.step(env_steps)
+
+    def train_async(self):
+        """Train with actor processes playing the game while this process keeps running optimize_model"""
+        ctx = mp.get_context('spawn')
+        experience_queue = ctx.Queue(maxsize=64*self.num_actors)
+        stop = ctx.Event()
+        # the learner publishes its weights to the actors through a model in shared memory
+        shared_model = make_model(self.args, self.actor.n_in, self.n_actions)
+        shared_model.load_state_dict(self.model.state_dict())
+        shared_model.share_memory()
+        weights_lock = ctx.Lock()
+        weights_version = ctx.Value('l', 0, lock=False)
+
+        processes = []
+        for i in range(self.num_actors):
+            process = ctx.Process(target=_actor_process, daemon=True,
+                                  args=(self.args, i, experience_queue, shared_model, weights_lock, weights_version, stop, self.actor.steps_done))
+            process.start()
+            processes.append(process)
+        receivers = [ExperienceReceiver(self.memory, self.num_envs, self.args.frame_hist_len, self.args.n_step) for _ in processes]
+
+        e = self.episodes_done
+        updates = 0
+        try:
+            while e < self.num_episodes:
+                # wait for experience only when there is nothing to learn from
+                message = None
+                try:
+                    message = experience_queue.get(block=len(self.memory) < self.batch_size or self.pending_updates < 1, timeout=1)
+                except queue.Empty:
+                    pass
+                while message is not None:
+                    actor_index, ops, episodes, env_steps = message
+                    with self.metrics.time('replay_push'):
+                        receivers[actor_index].ingest(ops)
+                    self.actor.steps_done += env_steps
+                    self.record_metrics(env_steps)
+                    self.pending_updates += self.replay_ratio * env_steps
+                    for total_reward, steps in episodes:
+                        if e < self.num_episodes:
+                            self.end_of_episode(e, total_reward, steps, train=True)
+                        e += 1
+                    try:
+                        message = experience_queue.get_nowait()
+                    except queue.Empty:
+                        message = None
+
+                if self.pending_updates >= 1 and len(self.memory) >= self.batch_size:
+                    self.optimize_model()
+                    self.pending_updates -= 1
+                    updates += 1
+                    if updates % self.weight_sync_every == 0:
+                        with weights_lock:
+                            for shared, param in zip(shared_model.state_dict().values(), self.model.state_dict().values()):
+                                shared.copy_(param)
+                            weights_version.value += 1
+        finally:
+            stop.set()
+            for process in processes:
+                process.join(timeout=10)
+                if process.is_alive():
+                    process.terminate()
+        # the episodes still running in the actor processes were not finished, start afresh
+        self.pending_updates = 0.
+
+    def end_of_episode(self, e, total_reward, steps, train):
+        self.writer.add_scalar('total_reward/train', total_reward, e)
+        self.writer.add_scalar('episode_duration/train', steps, e)
+        self.episode_durations.append(steps)
+        mean_duration = self.duration_mean.add(steps)
+        if self.duration_mean.full:
+            self.writer.add_scalar('episode_duration_mean100/train', mean_duration, e)
+        print("Episode {} completed after {} steps | Total steps = {} | Total reward = {}".format(e,steps,self.steps_done, total_reward))
+        self.plot_durations()
+        # self.plot_rewards()
+        if not train:
+            return
+        self.episodes_done += 1
+        self.episode_rewards.append(total_reward)
+        if self.save_model_every_epoch > 0 and e%self.save_model_every_epoch == 0:
+            # Save model to /saved_models/game_name/model_trained_epoch.pt
+            atomic_torch_save({
+                'epoch': e,
+                'model_state_dict': self.model.state_dict(),
+                'optimizer_state_dict': self.optimizer.state_dict(),
+                'reward': float(total_reward),
+                }, f'saved_models/{self.game_name}/model_trained_{e}.pt')
+        if self.checkpoint_every > 0 and self.episodes_done%self.checkpoint_every == 0:
+            self.save_checkpoint()
 
     def optimize_model(self):
         # check if enough experience collected so far
@@ -348,62 +2074,105 @@ class Agent(object):
         if len(self.memory) < self.batch_size:
             return 
 
-        self.optimizer.zero_grad()
+        self.optimizer.zero_grad(set_to_none=True)
         # sample a random batch from the replay memory to learn from experience
         # for no experience replay the batch size is 1 and hence learning online
-        transitions = self.memory.sample(self.batch_size)
-        batch = Transition(*zip(*transitions))
+        with self.metrics.time('replay_sample'):
+            if self.prefetcher is not None:
+                batch = self.prefetcher.sample_batch()
+            else:
+                batch = self.memory.sample_batch(self.batch_size)
+
+        # the networks run in mixed precision with amp, the Q-values and the loss stay float32
+        with self.metrics.time('forward'), autocast(self.amp):
+            # current Q-values: gather(dim, index) return the elements along the dim axis with given index.
+            current_Q = self.learner_model(batch.state).float().gather(1, batch.action.view([-1,1]))
+            # expected Q-values (target), a final state (the one after which simulation ended) has no future reward
+            # the reward is the discounted return of n steps and the discount gamma^n, both stored with the transition
+            with torch.no_grad():
+                max_next_Q = self.max_next_Q(batch.next_state).float().masked_fill_(batch.done, 0)
+                expected_Q = torch.addcmul(batch.reward, batch.discount, max_next_Q).view([-1,1])
 
-        # Compute a mask of non-final states and concatenate the batch elements
-        # (a final state would've been the one after which simulation ended)
-        non_final_mask = torch.tensor(tuple(map(lambda s: s is not None,
-                                            batch.next_state)), device=device, dtype=torch.bool)
-        
-        batch_next_state = torch.stack([s for s in batch.next_state if s is not None])
-        batch_state = torch.stack(batch.state)
-        batch_action = torch.stack(batch.action)
-        batch_reward = torch.stack(batch.reward)
-
-        # There is no separate target Q-network implemented and all updates are done
-        # synchronously at intervals of 1 unlike in the original paper
-        # current Q-values: gather(dim, index) return the elements along the dim axis with given index.
-        current_Q = self.model(batch_state).gather(1, batch_action.view([-1,1]))
-        # expected Q-values (target)
-        max_next_Q = torch.zeros(self.batch_size, device=device)
-        max_next_Q[non_final_mask] = self.model(batch_next_state).max(1)[0].detach()
-
-        expected_Q = (self.gamma * max_next_Q.view([-1,1])).data + batch_reward
-
-        # loss between current Q values and target Q values
-        if self.loss_fn == 'l1':
-            loss = F.smooth_l1_loss(current_Q, expected_Q)
-        else:
-            loss = F.mse_loss(current_Q, expected_Q)
+            # loss between current Q values and target Q values
+            if self.loss_fn == 'l1':
+                loss = F.smooth_l1_loss(current_Q, expected_Q, reduction='none')
+            else:
+                loss = F.mse_loss(current_Q, expected_Q, reduction='none')
+            # importance-sampling weights correct the bias of prioritized sampling
+            if batch.weight is not None:
+                loss = loss * batch.weight.view([-1,1])
+            loss = loss.mean()
 
         # backprop the loss
-        loss.backward()
-        self.optimizer.step()
-
-        return batch_reward.sum() # return the average of reward of the training data for reference
-        
-        # TODO write average reward and loss after each batch training
-        #self.writer.add_scalar('avg_loss/train', loss.mean(), e)
+        with self.metrics.time('backward'):
+            self.grad_scaler.scale(loss).backward()
+        with self.metrics.time('optimizer_step'):
+            if self.grad_clip > 0:
+                # the gradients are clipped at their true scale
+                self.grad_scaler.unscale_(self.optimizer)
+                nn.utils.clip_grad_norm_(self.model.parameters(), self.grad_clip)
+            self.grad_scaler.step(self.optimizer)
+            self.grad_scaler.update()
+        self.num_updates += 1
+        self.metrics.add('loss', loss.detach())
+        self.metrics.add('mean_Q', current_Q.detach().mean())
+        self.sync_target_model()
+
+        if batch.weight is not None:
+            td_errors = (expected_Q - current_Q.detach()).view(-1)
+            self.memory.update_priorities(batch.index, td_errors.cpu().numpy())
+
+        return batch.reward.sum() # return the average of reward of the training data for reference
+
+    def max_next_Q(self, next_state):
+        # without a target network the online network bootstraps from itself, as it used to
+        if self.target_model is None:
+            return self.model(next_state).max(1)[0]
+        next_Q = self.target_model(next_state)
+        if self.double_dqn:
+            # Double DQN: the online network picks the next action and the target network evaluates it
+            next_action = self.model(next_state).max(1)[1]
+            return next_Q.gather(1, next_action.view([-1,1])).view(-1)
+        return next_Q.max(1)[0]
+
+    def reset_target_model(self):
+        # the target network starts from the weights the online network was given
+        if self.target_model is not None:
+            self.target_model.load_state_dict(self.model.state_dict())
+
+    def sync_target_model(self):
+        if self.target_model is None or self.num_updates % self.target_update_every != 0:
+            return
+        with torch.no_grad():
+            for target, param in zip(self.target_model.parameters(), self.model.parameters()):
+                # a hard update is a soft one with tau = 1
+                target.lerp_(param, self.target_tau)
 
     def plot_durations(self):
-        durations = torch.FloatTensor(self.episode_durations)
-        plt.figure(1)
-        plt.clf()
-        plt.title('Training')
-        plt.xlabel('Episode')
-        plt.ylabel('Duration')
-        plt.plot(durations.numpy())
-        # Averaging over 100 episodes and plotting those values
-        if len(durations) >= 100:
-            means = durations.unfold(0, 100, 1).mean(1).view(-1)
-            means = torch.cat((torch.zeros(99), means))
-            plt.plot(means.numpy())
-        # pause so that the plots are updated
-        plt.pause(0.001)
+        num_episodes = len(self.episode_durations)
+        if self.plot == 'none' or (self.plot == 'png' and num_episodes % self.plot_every != 0):
+            return
+        if self.duration_plot is None:
+            figure = plt.figure(1)
+            axes = figure.gca()
+            axes.set_title('Training')
+            axes.set_xlabel('Episode')
+            axes.set_ylabel('Duration')
+            durations_line, = axes.plot([], [])
+            means_line, = axes.plot([], [])
+            self.duration_plot = (figure, axes, durations_line, means_line)
+        figure, axes, durations_line, means_line = self.duration_plot
+        # only the data of the lines is replaced, the means over 100 episodes start with the 100th episode
+        durations_line.set_data(np.arange(num_episodes), self.episode_durations)
+        means = self.duration_mean.means
+        means_line.set_data(np.arange(num_episodes - len(means), num_episodes), means)
+        axes.relim()
+        axes.autoscale_view()
+        if self.plot == 'png':
+            figure.savefig(os.path.join(self.writer.logdir, 'durations.png'))
+        else:
+            # pause so that the plots are updated
+            plt.pause(0.001)
 
     def plot_rewards(self):
         plt.figure(2)
@@ -417,91 +2186,480 @@ class Agent(object):
 
     def train(self):
         print("Going to be training for a total of {} episodes".format(self.num_episodes))
-        for e in range(self.num_episodes):
-            # print("----------- Episode {} -----------".format(e))
-            total_reward = self.play_episode(e,train=True) 
-            if self.save_model_every_epoch > 0 and e%self.save_model_every_epoch == 0:
-                # Save model to /saved_models/game_name/model_trained_epoch.pt
-                torch.save({
-                    'epoch': e,
-                    'model_state_dict': self.model.state_dict(),
-                    'optimizer_state_dict': self.optimizer.state_dict(),
-                    'reward': total_reward,
-                    }, f'saved_models/{self.game_name}/model_trained_{e}.pt')
-
+        if self.episodes_done >= self.num_episodes:
+            # a resumed run that already played all its episodes
+            return
+        if self.num_actors > 0:
+            self.train_async()
+        else:
+            self.play_episodes(self.num_episodes - self.episodes_done, train=True, first_episode=self.episodes_done)
 
     def test(self,num_episodes):
-        total_reward = 0
         print("-"*50)
         print("Testing for {} episodes".format(num_episodes))
-        for e in range(num_episodes):
-            total_reward += self.play_episode(e,train=False)
+        # the episodes are played in parallel and not stored in the replay memory
+        stats = evaluate(self.args, make_policy(self.args, self.model), num_episodes, self.args.eval_envs, self.args.eval_eps)
         print("Running policy after training for {} updates".format(self.steps_done))
-        print("Avg reward achieved in {} episodes : {}".format(num_episodes, total_reward/num_episodes))
+        print("Avg reward achieved in {} episodes : {}".format(num_episodes, stats['mean']))
+        print("Median {:.2f} | Stdev {:.2f} | 95% CI ({:.2f}, {:.2f}) | {:.0f} frames/sec".format(
+            stats['median'], stats['stdev'], *stats['ci95'], stats['frames_per_sec']))
         print("-"*50)
-        self.avg_rewards.append(total_reward/num_episodes)
+        self.avg_rewards.append(stats['mean'])
         # self.plot_rewards()
 
     def close(self):
         #self.env.render(close=True)
-        self.env.close()
-        plt.ioff()
-        plt.show()
+        self.checkpointer.wait()
+        self.metrics.close()
+        self.recorder.close()
+        if self.prefetcher is not None:
+            self.prefetcher.close()
+        self.envs.close()
+        self.writer.close()
+        if self.plot == 'window':
+            plt.ioff()
+            plt.show()
+
+################################################################################################################################################
+### Throughput benchmarks of the training loop stages on the stub environment, comparable between commits and machines
+
+def ops_per_sec(fn, min_time=1.0, warmup=3):
+    """Call fn for at least min_time seconds and return the number of calls per second"""
+    for _ in range(warmup):
+        fn()
+    num_calls = 0
+    start = time.perf_counter()
+    while True:
+        fn()
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        num_calls += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            return num_calls / elapsed
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    # ru_maxrss is in kilobytes on linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2**20 if sys.platform == 'darwin' else peak / 2**10
+
+def benchmark_replay(memory, num_envs, batch_size, min_time):
+    """Transitions stored and batches sampled per second, num_envs transitions are stored at a time"""
+    k = memory.frame_hist_len
+    frames = pre_process(StubAtariEnv().frames[np.arange(num_envs) % 64])
+    actions = np.arange(num_envs) % 6
+    rewards = np.ones(num_envs, dtype=np.float32)
+    dones = np.zeros(num_envs, dtype=np.bool_)
+    discounts = np.full(num_envs, 0.99, dtype=np.float32)
+    # the frames of an environment are num_envs ids apart, as when the actor stores them
+    offsets = num_envs*np.arange(k-1, -1, -1)
+
+    def push():
+        next_state_ids = memory.store_frames(frames)[:, None] - offsets
+        memory.store_transitions(next_state_ids - num_envs, actions, rewards, next_state_ids, dones, discounts)
+
+    push_per_sec = ops_per_sec(push, min_time)
+    # sample from a full memory
+    while len(memory) < memory.capacity:
+        push()
+    return {'push_transitions_per_sec': num_envs * push_per_sec,
+            'sample_batches_per_sec': ops_per_sec(lambda: memory.sample_batch(batch_size), min_time)}
+
+def benchmark_update(model, optimizer, batch, amp=False, grad_scaler=None, grad_clip=0.):
+    """One gradient update of model on batch, as done by Agent.optimize_model without a target network"""
+    optimizer.zero_grad(set_to_none=True)
+    with autocast(amp):
+        current_Q = model(batch.state).float().gather(1, batch.action.view([-1,1]))
+        with torch.no_grad():
+            max_next_Q = model(batch.next_state).float().max(1)[0].masked_fill_(batch.done, 0)
+            expected_Q = torch.addcmul(batch.reward, batch.discount, max_next_Q).view([-1,1])
+        loss = F.mse_loss(current_Q, expected_Q)
+    if grad_scaler is None:
+        grad_scaler = make_grad_scaler(argparse.Namespace(amp=0))
+    grad_scaler.scale(loss).backward()
+    if grad_clip > 0:
+        grad_scaler.unscale_(optimizer)
+        nn.utils.clip_grad_norm_(model.parameters(), grad_clip)
+    grad_scaler.step(optimizer)
+    grad_scaler.update()
+
+def saved_tensors_mb(fn):
+    """Size of the tensors kept for the backward pass by fn, the memory an update needs on top of the model"""
+    total = 0
+    def pack(tensor):
+        nonlocal total
+        total += tensor.numel() * tensor.element_size()
+        return tensor
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        fn()
+    return total / 2**20
+
+def benchmark_training(args, memory, min_time, batch_sizes=(32, 64, 128, 256, 512)):
+    """Updates/sec and memory per update of CNN_2c2f and DuelingDQN, in float32 and in mixed precision
+    with a fused optimizer, for every batch size"""
+    modes = {'fp32': {'amp': 0, 'fused_optimizer': 0}, 'amp fused': {'amp': 1, 'fused_optimizer': 1}}
+    results = {}
+    for model_type in ('CNN_2c2f', 'duel'):
+        for mode, options in modes.items():
+            mode_args = argparse.Namespace(**dict(vars(args), model_type=model_type, **options))
+            model = make_model(mode_args, args.frame_hist_len*84*84, 6).to(device)
+            optimizer = make_optimizer(mode_args, model.parameters())
+            grad_scaler = make_grad_scaler(mode_args)
+            for batch_size in batch_sizes:
+                batch = memory.sample_batch(batch_size)
+                if model_type != 'CNN_2c2f':
+                    # the fully connected models see the stacked frames flattened
+                    batch = batch._replace(state=batch.state.reshape(batch_size, -1),
+                                           next_state=batch.next_state.reshape(batch_size, -1))
+                update = lambda: benchmark_update(model, optimizer, batch, mode_args.amp, grad_scaler, args.grad_clip)
+                result = {'updates_per_sec': ops_per_sec(update, min_time), 'saved_tensors_mb': saved_tensors_mb(update)}
+                if device.type == 'cuda':
+                    torch.cuda.reset_peak_memory_stats()
+                    update()
+                    result['peak_gpu_mb'] = torch.cuda.max_memory_allocated() / 2**20
+                results.setdefault(type(model).__name__, {}).setdefault(mode, {})[f'batch_{batch_size}'] = result
+    return results
+
+def benchmark(args):
+    """Measure the throughput of every stage of the training loop on StubAtari-v0
+
+    The results are printed and written to args.benchmark_out as json.
+    """
+    args = copy.copy(args)
+    args.env = 'StubAtari-v0'
+    min_time = args.benchmark_time
+    random.seed(args.seed)
+    np.random.seed(args.seed)
+    torch.manual_seed(args.seed)
+    results = {'config': {'num_envs': args.num_envs, 'vec_env': args.vec_env, 'batch_size': args.batch_size,
+                          'buffer_size': args.buffer_size, 'frame_hist_len': args.frame_hist_len,
+                          'n_hidden': args.n_hidden, 'device': str(device), 'num_threads': torch.get_num_threads(),
+                          'torch': torch.__version__, 'numpy': np.__version__, 'python': platform.python_version()}}
+
+    # the environments alone, with a fixed sequence of actions
+    envs = make_vector_env(args.env, args.num_envs, args.vec_env)
+    envs.reset()
+    actions = itertools.cycle(np.random.RandomState(args.seed).randint(envs.action_space.n, size=(64, args.num_envs)))
+    results['env_steps_per_sec'] = args.num_envs * ops_per_sec(lambda: envs.step(next(actions)), min_time)
+    envs.close()
+
+    results['pre_process_frames_per_sec'] = benchmark_pre_process()
+
+    # the whole acting loop: action selection, environment step, preprocessing and replay writes
+    memory = ReplayMemory(args.buffer_size, args.frame_hist_len, num_envs=args.num_envs)
+    actor = Actor(args, CNN_2c2f(args.frame_hist_len).to(device), memory)
+    actor.reset()
+    results['actor_steps_per_sec'] = args.num_envs * ops_per_sec(actor.step, min_time)
+    actor.envs.close()
+
+    results['replay'] = {}
+    for name, memory_class in (('uniform', ReplayMemory), ('prioritized', PrioritizedReplayMemory)):
+        memory = memory_class(args.buffer_size, args.frame_hist_len, num_envs=args.num_envs)
+        results['replay'][name] = benchmark_replay(memory, args.num_envs, args.batch_size, min_time)
+
+    # the fully connected models see the stacked frames flattened
+    batch = memory.sample_batch(args.batch_size)
+    flat_batch = batch._replace(state=batch.state.reshape(args.batch_size, -1),
+                                next_state=batch.next_state.reshape(args.batch_size, -1))
+    n_in = flat_batch.state.size(1)
+    results['models'] = {}
+    for model_type in ('CNN_2c2f', 'dqn', 'duel', 'linear'):
+        model_args = copy.copy(args)
+        model_args.model_type = model_type
+        model = make_model(model_args, n_in, 6).to(device)
+        optimizer = make_optimizer(model_args, model.parameters())
+        grad_scaler = make_grad_scaler(model_args)
+        model_batch = batch if model_type == 'CNN_2c2f' else flat_batch
+        with torch.no_grad():
+            forward_per_sec = ops_per_sec(lambda: model(model_batch.state), min_time)
+        update = lambda: benchmark_update(model, optimizer, model_batch, args.amp, grad_scaler, args.grad_clip)
+        results['models'][type(model).__name__] = {
+            'forward_batches_per_sec': forward_per_sec,
+            'updates_per_sec': ops_per_sec(update, min_time)}
+
+    # float32 against mixed precision and fused optimizers over batch sizes
+    batch_sizes = [int(size) for size in args.benchmark_batch_sizes.split(',')]
+    results['training'] = benchmark_training(args, memory, min_time, batch_sizes)
+
+    # the acting network of CNN_2c2f, eager against the serving policies
+    model = CNN_2c2f(args.frame_hist_len).to(device)
+    results['inference'] = benchmark_inference(args, model, random_play_states(args), min_time)
+
+    results['peak_rss_mb'] = peak_rss_mb()
+
+    print(json.dumps(results, indent=2))
+    with open(args.benchmark_out, 'w') as f:
+        json.dump(results, f, indent=2)
+    return results
+
+################################################################################################################################################
+### Hyperparameter sweeps: trials trained in a process pool, with successive halving on the training reward
+
+def sweep_configs(spec, mode='grid', num_trials=16, seed=0):
+    """Settings of the trials of a sweep, spec maps argument names to their values.
+
+    A grid sweep tries every combination of the value lists, a random sweep draws num_trials settings
+    from the value lists or from {"low", "high", "log"} ranges.
+    """
+    if mode == 'grid':
+        for name, values in spec.items():
+            if not isinstance(values, list):
+                raise ValueError(f'a grid sweep needs a list of values for {name}, got {values}')
+        names = list(spec)
+        return [dict(zip(names, values)) for values in itertools.product(*(spec[name] for name in names))]
+    if mode != 'random':
+        raise ValueError(f'sweep_mode should be grid or random, got {mode}')
+    rng = random.Random(seed)
+
+    def draw(values):
+        if isinstance(values, list):
+            return rng.choice(values)
+        low, high = values['low'], values['high']
+        if values.get('log'):
+            return math.exp(rng.uniform(math.log(low), math.log(high)))
+        if isinstance(low, int) and isinstance(high, int):
+            return rng.randint(low, high)
+        return rng.uniform(low, high)
+    return [{name: draw(values) for name, values in spec.items()} for _ in range(num_trials)]
+
+def _init_sweep_worker(num_threads):
+    # the trials of the pool share the cores
+    torch.set_num_threads(num_threads)
+
+def _run_trial(args, trial_dir):
+    """Train a trial up to args.num_episodes episodes, resuming from its checkpoint.
+
+    The output goes to train.log in trial_dir, returns (mean total reward of the episodes played,
+    episodes done, error).
+    """
+    os.makedirs(trial_dir, exist_ok=True)
+    with open(os.path.join(trial_dir, 'train.log'), 'a') as log, contextlib.redirect_stdout(log):
+        try:
+            random.seed(args.seed)
+            np.random.seed(args.seed)
+            torch.manual_seed(args.seed)
+            agent = Agent(args)
+            if not agent.resumed:
+                agent.burn_memory()
+            agent.train()
+            # the next rung goes on from here
+            agent.save_checkpoint()
+            agent.close()
+        except Exception as error:
+            traceback.print_exc(file=log)
+            return None, 0, repr(error)
+    score = float(np.mean(agent.episode_rewards)) if agent.episode_rewards else None
+    return score, agent.episodes_done, None
+
+def run_sweep(args):
+    """Run the sweep of the json file args.sweep and write the results table to the sweep directory.
+
+    With sweep_rungs > 1 the trials are trained in rounds of increasing numbers of episodes, up to
+    num_episodes, and only the best 1/sweep_eta of the trials of a round, by their mean training reward
+    over the round, go on to the next one.
+    """
+    with open(args.sweep) as f:
+        spec = json.load(f)
+    unknown = set(spec) - set(vars(args))
+    if unknown:
+        raise ValueError(f'unknown arguments in the sweep: {sorted(unknown)}')
+    configs = sweep_configs(spec, args.sweep_mode, args.sweep_trials, args.seed)
+    sweep_dir = args.sweep_dir or os.path.join('sweeps', '{}_{}'.format(args.env, time.strftime('%Y%m%d-%H%M%S')))
+    num_rungs = args.sweep_rungs
+    eta = args.sweep_eta
+    budgets = [max(rung + 1, int(round(args.num_episodes / eta**(num_rungs - 1 - rung)))) for rung in range(num_rungs)]
+
+    trials = [{'trial': i, 'params': config, 'scores': [], 'episodes': 0, 'error': None} for i, config in enumerate(configs)]
+    num_workers = min(len(trials), args.sweep_workers or os.cpu_count())
+    num_threads = max(1, os.cpu_count() // num_workers)
+    print("Sweep of {} trials with {} workers of {} threads, episodes per rung {}, in {}".format(
+        len(trials), num_workers, num_threads, budgets, sweep_dir))
+
+    def rank(trial):
+        # failed trials come last
+        score = trial['scores'][-1] if trial['scores'] else None
+        return (trial['error'] is None and score is not None, score if score is not None else 0.)
+
+    alive = trials
+    with concurrent.futures.ProcessPoolExecutor(num_workers, mp_context=mp.get_context('spawn'),
+                                                initializer=_init_sweep_worker, initargs=(num_threads,)) as pool:
+        for rung, budget in enumerate(budgets):
+            futures = {}
+            for trial in alive:
+                trial_dir = os.path.join(sweep_dir, 'trial_{}'.format(trial['trial']))
+                trial_args = dict(vars(args))
+                trial_args.update(trial['params'])
+                # every trial keeps its own checkpoint, replay files and tensorboard run
+                trial_args.update(num_episodes=budget, resume=1, sweep='', checkpoint_every=0,
+                                  checkpoint_dir=os.path.join(trial_dir, 'checkpoint'), run_dir=trial_dir,
+                                  replay_dir=os.path.join(trial_dir, 'replay') if args.replay_dir else '',
+                                  record_video=0, save_model_every_epoch=0, plot='none')
+                futures[pool.submit(_run_trial, argparse.Namespace(**trial_args), trial_dir)] = trial
+            for future in concurrent.futures.as_completed(futures):
+                trial = futures[future]
+                score, trial['episodes'], trial['error'] = future.result()
+                # a round without new episodes keeps the score of the previous one
+                if score is not None or not trial['scores']:
+                    trial['scores'].append(score)
+                else:
+                    trial['scores'].append(trial['scores'][-1])
+                print("Rung {} | trial {} | {} episodes | score {} {}".format(
+                    rung, trial['trial'], trial['episodes'], trial['scores'][-1], trial['error'] or ''))
+            if rung < num_rungs - 1:
+                alive = sorted(alive, key=rank, reverse=True)[:max(1, math.ceil(len(alive) / eta))]
+
+    # the results table, the trials that went furthest first
+    trials.sort(key=lambda trial: (len(trial['scores']),) + rank(trial), reverse=True)
+    names = list(spec)
+    rows = [[trial['trial']] + [trial['params'][name] for name in names] +
+            [trial['episodes'], trial['scores'][-1], ' '.join(str(score) for score in trial['scores']), trial['error'] or '']
+            for trial in trials]
+    header = ['trial'] + names + ['episodes', 'score', 'rung_scores', 'error']
+    os.makedirs(sweep_dir, exist_ok=True)
+    with open(os.path.join(sweep_dir, 'results.csv'), 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(header)
+        writer.writerows(rows)
+    widths = [max(len(str(value)) for value in column) for column in zip(header, *rows)]
+    for row in [header] + rows:
+        print('  '.join(str(value).ljust(width) for value, width in zip(row, widths)))
+    print("Results written to {}".format(os.path.join(sweep_dir, 'results.csv')))
+    return trials
 
 def parse_arguments():
     parser = argparse.ArgumentParser(description='Deep Q Network Argument Parser')
     parser.add_argument('--env',type=str, default='SpaceInvaders-v0')
     parser.add_argument('--render',type=int,default=0)
+    parser.add_argument('--num_envs', type=int, default=1, help='number of environments stepped together')
+    parser.add_argument('--vec_env', type=str, default='sync', help='how to step the environments one of (sync,subproc) | Default : sync')
+    parser.add_argument('--num_actors', type=int, default=0, help='number of actor processes feeding a separate learner, 0 to act and learn in turn')
+    parser.add_argument('--distributed', type=int, default=0, help='data-parallel training over the ranks started by torchrun (gloo backend), default 0')
+    parser.add_argument('--replay_ratio', type=float, default=1.0, help='gradient updates per environment step')
+    parser.add_argument('--weight_sync_every', type=int, default=100, help='publish the learner weights to the actors every # updates')
+    parser.add_argument('--seed', type=int, default=0, help='random seed of the actor processes')
     parser.add_argument('--model_type',type=str, default='CNN_2c2f',help ='Model type one of (linear,dqn,duel)')
     parser.add_argument('--exp_replay', type=int, default=1, help='should experience replay be used, default 1')
     parser.add_argument('--num_episodes', type=int, default=10, help='number of episodes')
     parser.add_argument('--batch_size', type=int, default=2, help='batch size')
     parser.add_argument('--buffer_size', type=int, default=500, help='Replay memory buffer size')
+    parser.add_argument('--replay', type=str, default='uniform', help='replay memory one of (uniform,prioritized) | Default : uniform')
+    parser.add_argument('--alpha', type=float, default=0.6, help='prioritization exponent of prioritized replay')
+    parser.add_argument('--beta', type=float, default=0.4, help='importance-sampling exponent start value of prioritized replay, annealed to 1')
+    parser.add_argument('--beta_steps', type=int, default=100000, help='number of updates over which beta is annealed to 1')
+    parser.add_argument('--replay_dir', type=str, default='', help='keep the replay memory in memory mapped files of this directory instead of RAM')
+    parser.add_argument('--replay_prefetch', type=int, default=0, help='number of batches sampled ahead by a background thread, 0 to sample in the training loop')
     # parser.add_argument('--n_in', type=int, default=4, help='input layer size')
     # parser.add_argument('--n_out', type=int, default=256, help='output layer size')
     parser.add_argument('--loss_fn', type=str, default='l2', help='loss function one of (l1,l2) | Default: l1')
     parser.add_argument('--optimizer', type=str, default='rmsprop', help='optimizer one of (rmsprop,adam) | Default : rmsprop')
     parser.add_argument('--n_hidden', type=int, default=32, help='hidden layer size')
     parser.add_argument('--gamma', type=float, default=0.99, help='discount factor')
+    parser.add_argument('--n_step', type=int, default=1, help='number of rewards summed in the returns before bootstrapping | Default : 1')
+    parser.add_argument('--target_update', type=str, default='none', help='target network one of (none,hard:N,soft:tau) | Default : none')
+    parser.add_argument('--double_dqn', type=int, default=0, help='should the Double DQN target be used (needs a target network), default 0')
     parser.add_argument('--lr', type=float, default=0.0001, help='learning rate')
+    parser.add_argument('--amp', type=int, default=0, help='should the updates run in mixed precision (bfloat16 on cpu, float16 on gpu), default 0')
+    parser.add_argument('--fused_optimizer', type=int, default=0, help='should the optimizer use its fused or foreach implementation (fused Adam on the cpu needs torch 2.4), default 0')
+    parser.add_argument('--grad_clip', type=float, default=0., help='clip the gradient norm to this value, 0 to never')
     parser.add_argument('--frame_hist_len', type=int, default=4, help='frame history length | Default : 4')
+    parser.add_argument('--max_pool', type=int, default=1, help='max-pool consecutive frames to remove flickering, default 1')
     parser.add_argument('--eps_greedy', type=int, default=1, help='should policy be epsilon-greedy, default 1')
     parser.add_argument('--eps_start', type=float, default=0.95, help='e-greedy threshold start value')
     parser.add_argument('--eps_end', type=float, default=0.05, help='e-greedy threshold end value')
     parser.add_argument('--eps_decay', type=int, default=100000, help='e-greedy threshold decay')
+    parser.add_argument('--metrics_every', type=int, default=1000, help='write the stage timings and training metrics to tensorboard every # environment steps, 0 to never')
+    parser.add_argument('--profile', type=str, default='', help='capture a torch.profiler trace between two environment steps start:end into the tensorboard run directory')
+    parser.add_argument('--run_dir', type=str, default='', help='tensorboard run directory | Default : runs/<date>_<host>')
     parser.add_argument('--logs', type=str, default = 'logs',  help='logs path')
     parser.add_argument('--memory_burn_limit', type=int,default=200, help='Till when to burn memory')
     parser.add_argument('--record_video',type=int, default=10, help='Make record video every # episode')
+    parser.add_argument('--plot', type=str, default='png', help='episode duration plot one of (window,png,none), png saves it to the tensorboard run directory | Default : png')
+    parser.add_argument('--plot_every', type=int, default=10, help='save the png plot every # episodes')
     parser.add_argument('--load_pretrained_model', type=int, default=0, help='load pretrained mode')
     parser.add_argument('--save_model_every_epoch', type=int, default=10, help='Save model every amount of epochs')
     parser.add_argument('--model_path',type=str,default="model_saved.pt", help='File path to the pretrained model')
+    parser.add_argument('--checkpoint_every', type=int, default=0, help='Save a resumable checkpoint (replay memory included) every # episodes, 0 to never')
+    parser.add_argument('--checkpoint_dir', type=str, default='', help='Directory of the resumable checkpoint | Default : saved_models/env/checkpoint')
+    parser.add_argument('--resume', type=int, default=0, help='resume the training from the checkpoint in checkpoint_dir')
+    parser.add_argument('--evaluate', type=str, default='', help='only evaluate a model file, or all the model files of a directory such as saved_models/env in parallel')
+    parser.add_argument('--eval_episodes', type=int, default=10, help='number of episodes of an evaluation')
+    parser.add_argument('--eval_envs', type=int, default=8, help='number of environments stepped together by an evaluation')
+    parser.add_argument('--eval_eps', type=float, default=0.05, help='e-greedy threshold of the evaluation policy')
+    parser.add_argument('--eval_workers', type=int, default=0, help='number of processes evaluating the model files of a directory, 0 for one per core')
+    parser.add_argument('--inference', type=str, default='eager', help='network acting in the evaluations one of (eager,trace,compile), compile needs torch 2.0 | Default : eager')
+    parser.add_argument('--quantize', type=str, default='none', help='int8 quantization of the network acting in the evaluations one of (none,dynamic,static), runs on the cpu | Default : none')
+    parser.add_argument('--channels_last', type=int, default=0, help='should the network acting in the evaluations use the channels-last layout, default 0')
+    parser.add_argument('--sweep', type=str, default='', help='only run the hyperparameter sweep of this json file mapping argument names to lists of values')
+    parser.add_argument('--sweep_mode', type=str, default='grid', help='sweep one of (grid,random), random also takes {low,high,log} ranges | Default : grid')
+    parser.add_argument('--sweep_trials', type=int, default=16, help='number of trials of a random sweep')
+    parser.add_argument('--sweep_rungs', type=int, default=1, help='successive halving rounds, the best 1/sweep_eta of the trials of a round get sweep_eta times more episodes')
+    parser.add_argument('--sweep_eta', type=int, default=3, help='successive halving reduction factor | Default : 3')
+    parser.add_argument('--sweep_workers', type=int, default=0, help='number of processes training the trials, 0 for one per core')
+    parser.add_argument('--sweep_dir', type=str, default='', help='directory of the trials and of the results | Default : sweeps/env_<date>')
+    parser.add_argument('--benchmark', type=int, default=0, help='only measure the throughput of the training loop stages on StubAtari-v0')
+    parser.add_argument('--benchmark_out', type=str, default='benchmark.json', help='json file the benchmark results are written to | Default : benchmark.json')
+    parser.add_argument('--benchmark_batch_sizes', type=str, default='32,64,128,256,512', help='batch sizes of the training benchmark | Default : 32,64,128,256,512')
+    parser.add_argument('--benchmark_time', type=float, default=1.0, help='seconds spent measuring every benchmark | Default : 1.0')
+    parser.add_argument('--benchmark_preprocess', type=int, default=0, help='only print the frames/sec of the frame preprocessing')
     return parser.parse_args()
 
 def main():
-    plt.ion()
-    # plt.figure()
-    # plt.show()
-
     args = parse_arguments()
     print(args)
+    if args.plot == 'window':
+        plt.ion()
+        # plt.figure()
+        # plt.show()
+    else:
+        # no display needed
+        plt.switch_backend('Agg')
+    if args.benchmark:
+        benchmark(args)
+        return
+    if args.evaluate:
+        evaluate_checkpoints(args)
+        return
+    if args.sweep:
+        run_sweep(args)
+        return
+    if args.benchmark_preprocess:
+        benchmark_pre_process()
+        return
+    if args.distributed:
+        # torchrun sets the rank, the world size and the address of rank 0
+        dist.init_process_group('gloo')
+        rank = dist.get_rank()
+        random.seed(args.seed + rank)
+        np.random.seed(args.seed + rank)
+        torch.manual_seed(args.seed + rank)
     agent  = Agent(args)
 
     #agent.testing_random_play()    
     #pdb.set_trace()
 
-    agent.burn_memory()
+    # a resumed agent has its replay memory back already
+    if not agent.resumed:
+        agent.burn_memory()
     #pdb.set_trace()
     agent.train()
     print('----------- Completed Training -----------')
-    agent.test(num_episodes=10)
-    print('----------- Completed Testing -----------')
+    if agent.rank == 0:
+        agent.test(num_episodes=10)
+        print('----------- Completed Testing -----------')
 
     agent.close()
+    if args.distributed:
+        dist.destroy_process_group()
 
     ### Visualize the training progress by:
     #  pip install tensorboard
     #  tensorboard --logdir=runs
 
+    ### Train with 4 data-parallel ranks on this machine by:
+    #  torchrun --standalone --nproc_per_node=4 atari_game_fast.py --distributed 1
+
 if __name__ == '__main__':
     main()
 
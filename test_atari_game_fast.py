@@ -0,0 +1,429 @@
+"""Tests of atari_game_fast, they run on StubAtari-v0 which needs no ROMs.
+
+Run with python -m pytest -q
+"""
+import copy
+import sys
+import threading
+
+import numpy as np
+import pytest
+import torch
+
+import atari_game_fast as game
+
+
+def make_args(monkeypatch, *argv):
+    monkeypatch.setattr(sys, 'argv', ['atari_game_fast.py', '--env', 'StubAtari-v0', '--eps_start', '1'] + list(argv))
+    return game.parse_arguments()
+
+################################################################################################################################################
+### Replay memory: frame id ring
+
+def play(args, memory, steps, remote=False):
+    """Play steps steps of the actor, returns the (state, next_state) stacks of the actor of every transition stored.
+    With remote the actor sends its experience to the memory through an ExperienceSender and an ExperienceReceiver"""
+    if remote:
+        sender = game.ExperienceSender(ExperienceQueue(memory, args), 0, threading.Event())
+        actor = game.Actor(args, memory=sender)
+    else:
+        actor = game.Actor(args, memory=memory)
+    actor.model = game.make_model(args, actor.n_in, actor.n_actions)
+    actor.reset()
+    stacks = []
+    try:
+        for _ in range(steps):
+            state = actor.frame_stack.state().clone()
+            finished = actor.step(train=True)
+            next_state = actor.frame_stack.state().clone()
+            done = np.zeros(args.num_envs, dtype=np.bool_)
+            done[[i for i, _, _ in finished]] = True
+            for i in range(args.num_envs):
+                # the next state of a finished episode is not the first state of the next one
+                stacks.append((state[i], None if done[i] else next_state[i]))
+            if remote:
+                sender.flush([])
+    finally:
+        actor.envs.close()
+    return stacks
+
+def test_sampled_stacks_match_frame_stacks_after_the_ring_wraps(monkeypatch):
+    args = make_args(monkeypatch, '--num_envs', '2', '--buffer_size', '64')
+    memory = game.ReplayMemory(args.buffer_size, args.frame_hist_len, num_envs=args.num_envs)
+    stacks = play(args, memory, 600)
+    # both rings went around many times and the episodes of 500 steps ended
+    assert memory.num_frames > 10*memory.frame_capacity
+    assert memory.num_transitions == len(stacks)
+
+    checked = 0
+    for transition in range(memory.num_transitions - memory.size, memory.num_transitions):
+        position = np.array([transition % memory.capacity])
+        if not memory._is_valid(position)[0]:
+            continue
+        state, next_state = memory._gather_stacks(position)
+        assert np.array_equal(state[0], stacks[transition][0].numpy())
+        if stacks[transition][1] is not None:
+            assert np.array_equal(next_state[0], stacks[transition][1].numpy())
+        checked += 1
+    assert checked == memory.size
+
+    batch = memory.sample_batch(32)
+    for i, position in enumerate(batch.index):
+        transition = memory.num_transitions - 1 - (memory.position - 1 - position) % memory.capacity
+        assert torch.equal(batch.state[i], stacks[transition][0].float().div(255))
+
+################################################################################################################################################
+### Prioritized replay
+
+def test_sum_tree_sampling_frequencies():
+    rng = np.random.RandomState(0)
+    capacity = 100
+    tree = game.SumTree(capacity)
+    priorities = rng.rand(capacity)
+    priorities[rng.rand(capacity) < 0.2] = 0
+    # updates in two batches, one of them with repeated indices
+    tree.update(np.arange(50), priorities[:50])
+    tree.update(np.r_[np.arange(50, capacity), 60, 60], np.r_[priorities[50:], priorities[60], priorities[60]])
+    assert tree.total() == pytest.approx(priorities.sum())
+    assert np.array_equal(tree.get(np.arange(capacity)), priorities)
+    # the middle of the interval of every leaf in the cumulative sums finds that leaf
+    ends = np.cumsum(priorities)
+    leaves = np.flatnonzero(priorities)
+    assert np.array_equal(tree.find(ends[leaves] - priorities[leaves]/2), leaves)
+
+    num_samples = 200000
+    idx = tree.find(rng.rand(num_samples) * tree.total())
+    counts = np.bincount(idx, minlength=capacity)
+    assert len(counts) == capacity
+    assert counts[priorities == 0].sum() == 0
+    expected = num_samples * priorities / priorities.sum()
+    assert np.all(np.abs(counts - expected) < 5*np.sqrt(expected) + 1)
+
+def test_prioritized_memory_samples_by_priority(monkeypatch):
+    args = make_args(monkeypatch, '--num_envs', '2', '--buffer_size', '64')
+    memory = game.PrioritizedReplayMemory(args.buffer_size, args.frame_hist_len, num_envs=args.num_envs, alpha=1.)
+    play(args, memory, 100)
+    idx = np.arange(memory.size)
+    memory.update_priorities(idx, np.where(idx % 2 == 0, 3., 1.) - memory.eps)
+    counts = np.zeros(memory.capacity)
+    for _ in range(200):
+        counts += np.bincount(memory.sample_batch(64).index, minlength=memory.capacity)
+    assert counts[::2].sum() / counts.sum() == pytest.approx(0.75, abs=0.02)
+
+################################################################################################################################################
+### Frame preprocessing
+
+def test_batched_pre_process_matches_frame_by_frame():
+    frames = game.StubAtariEnv().frames[:8]
+    batched = game.pre_process(frames)
+    assert batched.shape == (8, 84, 84) and batched.dtype == np.uint8
+    for frame, expected in zip(frames, batched):
+        assert np.array_equal(game.pre_process(frame), expected)
+
+def test_max_pool_pools_with_the_previous_frame_of_the_same_episode():
+    frames = game.StubAtariEnv().frames
+    pooled = lambda previous, current: game.resize(np.maximum(game.grayscale(previous), game.grayscale(current)))
+    preprocessor = game.FramePreprocessor(max_pool=True)
+    # the first frames of the episodes are not pooled
+    assert np.array_equal(preprocessor.reset(frames[0:3]), game.pre_process(frames[0:3]))
+    assert np.array_equal(preprocessor(frames[3:6]), pooled(frames[0:3], frames[3:6]))
+    # the second environment starts a new episode, its next frame is pooled with the first one of that episode only
+    reset = np.array([False, True, False])
+    assert np.array_equal(preprocessor.reset(frames[7:8], reset), game.pre_process(frames[7:8]))
+    expected = pooled(frames[[3, 7, 5]], frames[8:11])
+    assert np.array_equal(preprocessor(frames[8:11]), expected)
+
+    preprocessor = game.FramePreprocessor(max_pool=False)
+    preprocessor.reset(frames[0:3])
+    assert np.array_equal(preprocessor(frames[3:6]), game.pre_process(frames[3:6]))
+
+################################################################################################################################################
+### Frame stacks
+
+def test_frame_stack_keeps_the_last_frames_of_every_environment():
+    rng = np.random.RandomState(0)
+    num_envs, k = 3, 4
+    stack = game.FrameStack(num_envs, k, frame_shape=(2, 2))
+    # the frames hold their ids, reference stacks are kept as lists
+    frames = lambda ids: torch.as_tensor(ids, dtype=torch.uint8)[:, None, None].expand(-1, 2, 2)
+    ids = np.arange(num_envs)
+    stack.reset(frames(ids), ids)
+    expected = [[i]*k for i in ids]
+    next_id = num_envs
+    for _ in range(50):
+        ids = next_id + np.arange(num_envs)
+        next_id += num_envs
+        stack.push(frames(ids), ids)
+        expected = [e[1:] + [i] for e, i in zip(expected, ids)]
+        reset = rng.rand(num_envs) < 0.2
+        if reset.any():
+            ids = next_id + np.arange(reset.sum())
+            next_id += len(ids)
+            stack.reset(frames(ids), ids, reset)
+            for i, new_id in zip(np.flatnonzero(reset), ids):
+                expected[i] = [new_id]*k
+        assert np.array_equal(stack.ids(), expected)
+        assert np.array_equal(stack.state()[:, :, 0, 0].numpy(), np.array(expected) % 256)
+
+################################################################################################################################################
+### Actor processes: experience sent with frame ids local to the actor
+
+class ExperienceQueue(object):
+    """Passes the messages of an ExperienceSender straight to an ExperienceReceiver, in process"""
+
+    def __init__(self, memory, args):
+        self.receiver = game.ExperienceReceiver(memory, args.num_envs, args.frame_hist_len, args.n_step)
+
+    def put(self, message, timeout=None):
+        self.receiver.ingest(message[1])
+
+def test_received_stacks_match_the_frame_stacks_of_the_actor(monkeypatch):
+    args = make_args(monkeypatch, '--num_envs', '2', '--buffer_size', '64')
+    memory = game.ReplayMemory(args.buffer_size, args.frame_hist_len, num_envs=args.num_envs)
+    stacks = play(args, memory, 600, remote=True)
+    assert memory.num_transitions == len(stacks)
+
+    valid = np.flatnonzero(memory._is_valid(np.arange(memory.size)))
+    assert len(valid) == memory.size
+    states, next_states = memory._gather_stacks(valid)
+    for position, state, next_state in zip(valid, states, next_states):
+        transition = memory.num_transitions - 1 - (memory.position - 1 - position) % memory.capacity
+        assert np.array_equal(state, stacks[transition][0].numpy())
+        if stacks[transition][1] is not None:
+            assert np.array_equal(next_state, stacks[transition][1].numpy())
+
+################################################################################################################################################
+### Target network
+
+@pytest.fixture
+def make_agent(monkeypatch, tmp_path):
+    """Makes agents writing their logs, models and checkpoints to tmp_path"""
+    monkeypatch.chdir(tmp_path)
+    agents = []
+    def make(*argv):
+        args = make_args(monkeypatch, '--record_video', '0', '--plot', 'none', '--run_dir', 'runs', '--buffer_size', '200',
+                         '--batch_size', '8', '--memory_burn_limit', '50', *argv)
+        agents.append(game.Agent(args))
+        return agents[-1]
+    yield make
+    for agent in agents:
+        agent.close()
+
+def perturb(model):
+    with torch.no_grad():
+        for param in model.parameters():
+            param.add_(torch.randn_like(param))
+
+def same_weights(a, b):
+    return all(torch.equal(x, y) for x, y in zip(a.state_dict().values(), b.state_dict().values()))
+
+def test_hard_target_update_copies_every_n_updates(make_agent):
+    agent = make_agent('--target_update', 'hard:3')
+    initial = copy.deepcopy(agent.target_model)
+    perturb(agent.model)
+    for num_updates in (1, 2):
+        agent.num_updates = num_updates
+        agent.sync_target_model()
+        assert same_weights(agent.target_model, initial)
+    agent.num_updates = 3
+    agent.sync_target_model()
+    assert same_weights(agent.target_model, agent.model)
+
+def test_soft_target_update_moves_by_tau(make_agent):
+    agent = make_agent('--target_update', 'soft:0.25')
+    initial = copy.deepcopy(agent.target_model)
+    perturb(agent.model)
+    agent.num_updates = 1
+    agent.sync_target_model()
+    for target, start, param in zip(agent.target_model.parameters(), initial.parameters(), agent.model.parameters()):
+        assert torch.allclose(target, start + 0.25*(param - start), atol=1e-6)
+
+@pytest.mark.parametrize('double_dqn', [0, 1])
+def test_next_q_values_of_the_target_network(make_agent, double_dqn):
+    agent = make_agent('--target_update', 'hard:100', '--double_dqn', str(double_dqn))
+    perturb(agent.model)
+    next_state = torch.rand(64, 4, 84, 84)
+    with torch.no_grad():
+        next_Q = agent.max_next_Q(next_state)
+        target_Q = agent.target_model(next_state)
+        online_action = agent.model(next_state).max(1)[1]
+    if double_dqn:
+        # the online network picks the action, the target network evaluates it
+        assert torch.equal(next_Q, target_Q.gather(1, online_action.view(-1, 1)).view(-1))
+        assert not torch.equal(next_Q, target_Q.max(1)[0])
+    else:
+        assert torch.equal(next_Q, target_Q.max(1)[0])
+
+def test_target_network_starts_from_the_pretrained_model(make_agent):
+    pretrained = make_agent()
+    model = pretrained.model
+    perturb(model)
+    torch.save({'model_state_dict': model.state_dict(), 'optimizer_state_dict': pretrained.optimizer.state_dict()}, 'pretrained.pt')
+    agent = make_agent('--target_update', 'hard:1000', '--load_pretrained_model', '1', '--model_path', 'pretrained.pt')
+    assert same_weights(agent.model, model)
+    assert same_weights(agent.target_model, model)
+
+@pytest.mark.parametrize('argv', [('--target_update', 'hard:0'), ('--target_update', 'soft:0'), ('--target_update', 'soft:1.5'),
+                                  ('--target_update', 'every:10'), ('--double_dqn', '1')])
+def test_invalid_target_options(make_agent, argv):
+    with pytest.raises(ValueError):
+        make_agent(*argv)
+
+################################################################################################################################################
+### Resumable checkpoints
+
+def encoded_frame(frame_id):
+    # the id of the frame is written in its first pixels
+    frame = np.zeros((84, 84), dtype=np.uint8)
+    frame[0, :3] = [(frame_id >> shift) & 255 for shift in (0, 8, 16)]
+    return frame
+
+def decoded_id(frame):
+    return int(frame[0, 0]) | int(frame[0, 1]) << 8 | int(frame[0, 2]) << 16
+
+def push_steps(memory, steps):
+    """Store one new frame per step and a transition between the stacks of the last frames"""
+    for _ in range(steps):
+        frame_id = memory.store_frames(encoded_frame(memory.num_frames)[None])[0]
+        state_ids = np.maximum(frame_id - np.arange(4, 0, -1), 0)
+        next_state_ids = np.append(state_ids[1:], frame_id)
+        memory.store_transitions(state_ids[None], [frame_id % 6], [1.], next_state_ids[None], [False], [0.99])
+
+def test_checkpoint_round_trip_while_the_memory_changes(monkeypatch, tmp_path):
+    memory = game.ReplayMemory(100)
+    checkpointer = game.Checkpointer(str(tmp_path))
+    # 12 transitions or a single frame per chunk, and the training loop storing 30 steps after the first chunk
+    monkeypatch.setattr(game.Checkpointer, 'chunk_bytes', 1000)
+    chunks = game.Checkpointer._chunks
+    pending = []
+    def chunks_with_steps(self, ids, arrays):
+        for chunk in chunks(self, ids, arrays):
+            yield chunk
+            if pending:
+                push_steps(memory, pending.pop())
+    monkeypatch.setattr(game.Checkpointer, '_chunks', chunks_with_steps)
+
+    for save in range(3):
+        push_steps(memory, 250)
+        num_transitions = memory.num_transitions
+        pending.append(30)
+        checkpointer.save({'save': save}, memory)
+        checkpointer.wait()
+        assert memory.num_transitions == num_transitions + 30
+
+        loaded = game.ReplayMemory(100)
+        state, memory_loaded = game.Checkpointer(str(tmp_path)).load(loaded)
+        assert memory_loaded and state['save'] == save
+        assert loaded.num_transitions == num_transitions
+        # the rows overwritten before the copy reached them are stale, the first chunk was copied before
+        overwritten = np.arange(num_transitions - 100 + 12, num_transitions - 100 + 30) % 100
+        assert not loaded._is_valid(overwritten).any()
+        # every other transition is stale or has the frames and action it was stored with
+        valid = np.flatnonzero(loaded._is_valid(np.arange(loaded.size)))
+        assert len(valid) >= 60
+        ids = np.concatenate((loaded.state_ids[valid], loaded.next_state_ids[valid]), axis=1)
+        states, next_states = loaded._gather_stacks(valid)
+        for frame_ids, frames in zip(ids, np.concatenate((states, next_states), axis=1)):
+            assert [decoded_id(frame) for frame in frames] == list(frame_ids)
+        assert np.array_equal(loaded.actions[valid], ids[:, -1] % 6)
+
+def test_agent_resumes_from_its_checkpoint(make_agent):
+    agent = make_agent('--checkpoint_dir', 'checkpoint', '--optimizer', 'adam', '--target_update', 'soft:0.1')
+    agent.burn_memory()
+    agent.learn(20)
+    agent.episodes_done = 3
+    agent.save_checkpoint()
+    agent.checkpointer.wait()
+    draws = np.random.rand(3), torch.rand(3)
+
+    resumed = make_agent('--checkpoint_dir', 'checkpoint', '--optimizer', 'adam', '--target_update', 'soft:0.1', '--resume', '1')
+    assert resumed.resumed
+    assert np.array_equal(np.random.rand(3), draws[0]) and torch.equal(torch.rand(3), draws[1])
+    assert (resumed.episodes_done, resumed.steps_done, resumed.num_updates) == (3, agent.steps_done, 20)
+    assert same_weights(resumed.model, agent.model) and same_weights(resumed.target_model, agent.target_model)
+    assert resumed.optimizer.state_dict()['state'][0]['step'] == 20
+    assert resumed.memory.state_dict() == agent.memory.state_dict()
+    for name, array in agent.memory.arrays().items():
+        assert np.array_equal(resumed.memory.arrays()[name], array)
+
+################################################################################################################################################
+### Evaluation
+
+def test_return_statistics():
+    stats = game.return_statistics([1., 2., 3., 4.], 2., 10)
+    stdev = np.std([1, 2, 3, 4], ddof=1)
+    assert (stats['episodes'], stats['mean'], stats['median'], stats['min'], stats['max']) == (4, 2.5, 2.5, 1., 4.)
+    assert stats['stdev'] == pytest.approx(stdev)
+    assert stats['ci95'] == pytest.approx((2.5 - 1.96*stdev/2, 2.5 + 1.96*stdev/2))
+    assert stats['frames_per_sec'] == 5.
+
+    stats = game.return_statistics([7.], 1., 1)
+    assert (stats['stdev'], stats['ci95']) == (0., (7., 7.))
+
+def test_evaluate_plays_the_share_of_every_environment(monkeypatch):
+    args = make_args(monkeypatch)
+    # zero Q-values always pick action 0, which gets a reward every 10 of the 500 steps of an episode
+    model = game.LinearQN(args.frame_hist_len*84*84, 6)
+    torch.nn.init.zeros_(model.fc.weight)
+    torch.nn.init.zeros_(model.fc.bias)
+    calls = []
+    monkeypatch.setattr(game, 'return_statistics', lambda returns, seconds, frames: calls.append((list(returns), frames)))
+    game.evaluate(args, model, num_episodes=5, num_envs=3, epsilon=0.)
+    # quotas of 2, 2 and 1 episodes, the frames of the third environment stop counting after its episode
+    assert calls == [([50.]*5, 5*500)]
+
+################################################################################################################################################
+### n-step returns
+
+def brute_force_returns(history, n, gamma):
+    """The n-step transitions of the (state, action, reward, next_state, done) history of one environment"""
+    expected = []
+    episodes, current = [], []
+    for transition in history:
+        current.append(transition)
+        if transition[4]:
+            episodes.append(current)
+            current = []
+    for episode in episodes:
+        for j in range(len(episode)):
+            window = episode[j:j+n]
+            expected.append((window[0][0], window[0][1], sum(gamma**m * t[2] for m, t in enumerate(window)),
+                             window[-1][3], window[-1][4], gamma**len(window)))
+    # the windows of the unfinished episode that are already full
+    for j in range(len(current) - n + 1):
+        window = current[j:j+n]
+        expected.append((window[0][0], window[0][1], sum(gamma**m * t[2] for m, t in enumerate(window)),
+                         window[-1][3], False, gamma**n))
+    return expected
+
+@pytest.mark.parametrize('n', [1, 3, 5])
+def test_n_step_returns_match_brute_force(n):
+    rng = np.random.RandomState(0)
+    num_envs, gamma, k = 3, 0.9, 2
+    n_step_returns = game.NStepReturns(num_envs, n, gamma, k)
+    # the state id of every environment counts its steps, apart for every environment
+    state = np.arange(num_envs) * 10**6
+    histories = [[] for _ in range(num_envs)]
+    output = []
+    for _ in range(300):
+        actions = rng.randint(6, size=num_envs)
+        rewards = rng.rand(num_envs)
+        dones = rng.rand(num_envs) < 0.1
+        next_state = state + 1
+        for i in range(num_envs):
+            histories[i].append((state[i], actions[i], rewards[i], next_state[i], dones[i]))
+        completed = n_step_returns.add(np.repeat(state[:, None], k, axis=1), actions, rewards,
+                                       np.repeat(next_state[:, None], k, axis=1), dones)
+        if completed is not None:
+            for s, a, r, s_next, done, discount in zip(*completed):
+                output.append((s[0], a, r, s_next[0], bool(done), discount))
+        state = next_state + np.where(dones, 1000, 0)
+    expected = [t for history in histories for t in brute_force_returns(history, n, gamma)]
+
+    key = lambda t: (int(t[0]), int(t[1]))
+    output, expected = sorted(output, key=key), sorted(expected, key=key)
+    assert len(output) == len(expected)
+    for got, want in zip(output, expected):
+        assert (int(got[0]), int(got[1]), int(got[3]), got[4]) == (int(want[0]), int(want[1]), int(want[3]), want[4])
+        assert got[2] == pytest.approx(want[2])
+        assert got[5] == pytest.approx(want[5])